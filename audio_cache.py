@@ -0,0 +1,164 @@
+import hashlib
+import sys
+from collections import OrderedDict
+from multiprocessing import resource_tracker, shared_memory, util
+import numpy as np
+from meldataset import MAX_WAV_VALUE
+
+_HEADER = np.dtype([('length', '<i8'), ('ready', '<i8')])
+
+
+def _attach(name):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # Attaching registers the name with the resource tracker again. Workers share their parent's
+    # tracker, which keeps one entry per name, so unregistering here would drop the creator's entry;
+    # leave it and let the creator unlink the segment.
+    return shared_memory.SharedMemory(name=name)
+
+
+def _unlink_segments(names):
+    for name in names:
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            continue
+        shm.close()
+        shm.unlink()
+
+
+class AudioCache(object):
+    """Byte-budgeted LRU cache of decoded audio, private to each DataLoader worker.
+
+    Audio is kept as float32, or as int16 PCM (`dtype='int16'`) to fit twice as much in the budget;
+    `scale` converts stored samples back to [-1, 1]. With `shared=True` a second tier of POSIX shared
+    memory segments is readable without copying by every worker and every DDP rank on the host.
+    Segments are named after the file, `namespace` (a per-run id), the dtype and `sampling_rate`, so
+    runs with other settings never attach them. Each process creates at most `shared_max_bytes` of
+    segments and unlinks them when it exits. Every mapped segment holds a file descriptor, so only the
+    `max_open_segments` most recently used ones stay mapped; the rest are attached again when read.
+    """
+    def __init__(self, max_bytes, dtype='float32', shared=False, shared_max_bytes=0, namespace='hifigan',
+                 sampling_rate=None, max_open_segments=128):
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        self.scale = 1. / MAX_WAV_VALUE if self.dtype == np.int16 else 1.
+        self.shared = shared
+        self.shared_max_bytes = shared_max_bytes
+        self.namespace = namespace
+        self.sampling_rate = sampling_rate
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.max_open_segments = max_open_segments
+        self._segments = OrderedDict()
+        self._closing = []
+        self._created = []
+        self._shared_bytes = 0
+        self._finalizer = None
+        if shared:
+            resource_tracker.ensure_running()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_entries'] = OrderedDict()
+        state['_bytes'] = 0
+        state['_segments'] = OrderedDict()
+        state['_closing'] = []
+        state['_created'] = []
+        state['_shared_bytes'] = 0
+        state['_finalizer'] = None
+        return state
+
+    def _to_stored(self, audio):
+        if self.dtype == np.int16:
+            return np.clip(audio * MAX_WAV_VALUE, -MAX_WAV_VALUE, MAX_WAV_VALUE - 1).astype(np.int16)
+        return np.asarray(audio, dtype=self.dtype)
+
+    def _segment_name(self, key):
+        identity = '{}|{}|{}|{}'.format(self.namespace, self.dtype.str, self.sampling_rate, key)
+        return 'hifigan_{}'.format(hashlib.sha1(identity.encode('utf-8')).hexdigest()[:24])
+
+    def _keep_open(self, key, shm, audio):
+        """Remember a mapped segment, closing the least recently used ones beyond max_open_segments."""
+        self._segments[key] = (shm, audio)
+        while len(self._segments) > self.max_open_segments:
+            self._closing.append(self._segments.popitem(last=False)[1][0])
+        closing, self._closing = self._closing, []
+        for shm in closing:
+            try:
+                shm.close()
+            except BufferError:
+                # A caller still holds an array into the segment; close it on a later eviction.
+                self._closing.append(shm)
+
+    def _shared_get(self, key):
+        if key in self._segments:
+            self._segments.move_to_end(key)
+            return self._segments[key][1]
+        try:
+            shm = _attach(self._segment_name(key))
+        except (OSError, ValueError):
+            # Missing, or created but not sized yet (mmap of an empty file raises ValueError).
+            return None
+        if shm.size < _HEADER.itemsize:
+            shm.close()
+            return None
+        header = np.ndarray((), dtype=_HEADER, buffer=shm.buf)
+        if header['ready'] != 1:
+            # Still being written by its creator; read from disk this time.
+            del header
+            shm.close()
+            return None
+        audio = np.ndarray((int(header['length']),), dtype=self.dtype, buffer=shm.buf, offset=_HEADER.itemsize)
+        del header
+        self._keep_open(key, shm, audio)
+        return audio
+
+    def _shared_put(self, key, audio):
+        if self._shared_bytes + audio.nbytes > self.shared_max_bytes:
+            return None
+        try:
+            shm = shared_memory.SharedMemory(name=self._segment_name(key), create=True,
+                                             size=_HEADER.itemsize + max(audio.nbytes, 1))
+        except FileExistsError:
+            return None
+        shared = np.ndarray(audio.shape, dtype=self.dtype, buffer=shm.buf, offset=_HEADER.itemsize)
+        shared[:] = audio
+        header = np.ndarray((), dtype=_HEADER, buffer=shm.buf)
+        header['length'] = len(audio)
+        header['ready'] = 1
+        del header
+        self._shared_bytes += audio.nbytes
+        self._created.append(shm.name)
+        self._keep_open(key, shm, shared)
+        if self._finalizer is None:
+            # DataLoader workers leave through os._exit, which skips atexit but runs multiprocessing
+            # finalizers.
+            self._finalizer = util.Finalize(self, _unlink_segments, args=(self._created,), exitpriority=10)
+        return shared
+
+    def get(self, key):
+        """Return the stored audio for `key`, or None when it is in neither tier."""
+        audio = self._entries.get(key)
+        if audio is not None:
+            self._entries.move_to_end(key)
+            return audio
+        if self.shared:
+            return self._shared_get(key)
+        return None
+
+    def put(self, key, audio):
+        """Store float audio in [-1, 1] under `key` and return the stored array."""
+        audio = self._to_stored(audio)
+        if self.shared:
+            shared = self._shared_put(key, audio)
+            if shared is not None:
+                return shared
+        if audio.nbytes > self.max_bytes:
+            return audio
+        self._entries[key] = audio
+        self._bytes += audio.nbytes
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+        return audio
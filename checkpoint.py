@@ -0,0 +1,138 @@
+import argparse
+import json
+import os
+import struct
+import torch
+
+TENSOR_FILE_MAGIC = b'HIFIGANT'
+TENSOR_FILE_VERSION = 1
+_ALIGN = 64
+_PREFIX = struct.Struct('<8sQ')
+
+
+def _align(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def _encode(o, path, tensors):
+    if torch.is_tensor(o):
+        tensors.append((path, o))
+        return {'__tensor__': path}
+    if isinstance(o, dict):
+        if all(isinstance(k, str) for k in o):
+            return {k: _encode(v, path + '/' + k, tensors) for k, v in o.items()}
+        # Optimizer states are keyed by parameter index, which JSON objects cannot hold.
+        return {'__items__': [[k, _encode(v, '{}/{}'.format(path, k), tensors)] for k, v in o.items()]}
+    if isinstance(o, tuple):
+        return {'__tuple__': [_encode(v, '{}/{}'.format(path, i), tensors) for i, v in enumerate(o)]}
+    if isinstance(o, list):
+        return [_encode(v, '{}/{}'.format(path, i), tensors) for i, v in enumerate(o)]
+    return o
+
+
+def _decode(o, get_tensor):
+    if isinstance(o, dict):
+        if '__tensor__' in o:
+            return get_tensor(o['__tensor__'])
+        if '__items__' in o:
+            return {k: _decode(v, get_tensor) for k, v in o['__items__']}
+        if '__tuple__' in o:
+            return tuple(_decode(v, get_tensor) for v in o['__tuple__'])
+        return {k: _decode(v, get_tensor) for k, v in o.items()}
+    if isinstance(o, list):
+        return [_decode(v, get_tensor) for v in o]
+    return o
+
+
+def save_tensor_file(filepath, obj):
+    """Write a checkpoint dict as a JSON header followed by the raw bytes of every tensor.
+
+    Each tensor is stored contiguously at a 64-byte aligned offset, so load_tensor_file can map the file
+    and view tensors in place instead of unpickling them.
+    """
+    tensors = []
+    structure = _encode(obj, '', tensors)
+    index = {}
+    offset = 0
+    for name, t in tensors:
+        nbytes = t.numel() * t.element_size()
+        index[name] = {'dtype': str(t.dtype).split('.')[-1], 'shape': list(t.shape), 'offset': offset,
+                       'nbytes': nbytes}
+        offset = _align(offset + nbytes)
+    header = json.dumps({'version': TENSOR_FILE_VERSION, 'structure': structure, 'tensors': index}).encode('utf-8')
+    header += b' ' * (_align(_PREFIX.size + len(header)) - _PREFIX.size - len(header))
+
+    with open(filepath, 'wb') as f:
+        f.write(_PREFIX.pack(TENSOR_FILE_MAGIC, len(header)))
+        f.write(header)
+        for name, t in tensors:
+            data = t.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy()
+            f.write(data.tobytes())
+            f.write(b'\0' * (_align(len(data)) - len(data)))
+
+
+def is_tensor_file(filepath):
+    with open(filepath, 'rb') as f:
+        return f.read(len(TENSOR_FILE_MAGIC)) == TENSOR_FILE_MAGIC
+
+
+def load_tensor_file(filepath, keys=None, device=None):
+    """Load a file written by save_tensor_file, mapping it rather than reading it.
+
+    Only the top-level `keys` (all when None) are returned and only their tensors are ever paged in.
+    On CPU the tensors are private copy-on-write views of the mapping.
+    """
+    with open(filepath, 'rb') as f:
+        magic, header_len = _PREFIX.unpack(f.read(_PREFIX.size))
+        if magic != TENSOR_FILE_MAGIC:
+            raise ValueError("{} is not a tensor file".format(filepath))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    if header.get('version') != TENSOR_FILE_VERSION:
+        raise ValueError("{} has tensor file version {}, expected {}".format(
+            filepath, header.get('version'), TENSOR_FILE_VERSION))
+
+    data_start = _PREFIX.size + header_len
+    buf = torch.from_file(filepath, shared=False, size=os.path.getsize(filepath), dtype=torch.uint8)
+    index = header['tensors']
+
+    def get_tensor(name):
+        entry = index[name]
+        start = data_start + entry['offset']
+        t = buf[start:start + entry['nbytes']].view(getattr(torch, entry['dtype'])).reshape(entry['shape'])
+        return t.to(device) if device is not None else t
+
+    structure = header['structure']
+    if keys is not None:
+        structure = {k: structure[k] for k in keys}
+    return _decode(structure, get_tensor)
+
+
+def load_checkpoint(filepath, device, keys=None):
+    """Load a torch.save or tensor file checkpoint, keeping only the top-level `keys` when given."""
+    assert os.path.isfile(filepath)
+    print("Loading '{}'".format(filepath))
+    if is_tensor_file(filepath):
+        checkpoint_dict = load_tensor_file(filepath, keys, device)
+    else:
+        checkpoint_dict = torch.load(filepath, map_location=device)
+        if keys is not None:
+            checkpoint_dict = {k: checkpoint_dict[k] for k in keys}
+    print("Complete.")
+    return checkpoint_dict
+
+
+def main():
+    print('Converting checkpoint..')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_checkpoint', required=True)
+    parser.add_argument('--output_checkpoint', required=True)
+    parser.add_argument('--keys', nargs='*', default=None)
+    a = parser.parse_args()
+
+    save_tensor_file(a.output_checkpoint, load_checkpoint(a.input_checkpoint, 'cpu', a.keys))
+    print('Wrote {}'.format(a.output_checkpoint))
+
+
+if __name__ == '__main__':
+    main()
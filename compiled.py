@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+import torch
+from export import load_inference_generator, load_scripted_generator, save_scripted_generator, \
+    scripted_generator_meta
+from onnx_backend import is_onnx_generator
+
+
+def compile_key(checkpoint_file, h, device, fuse=False):
+    """Hash of the config, the checkpoint contents, the device type, the fused flag and the torch version."""
+    sha1 = hashlib.sha1()
+    sha1.update(json.dumps(dict(h), sort_keys=True).encode('utf-8'))
+    sha1.update('{}|{}|{}'.format(torch.device(device).type, fuse, torch.__version__).encode('utf-8'))
+    with open(checkpoint_file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def script_generator(generator, h, example_frames=64):
+    """Trace, freeze and optimize a weight-norm-free generator for CPU inference.
+
+    Generator.forward has no shape-dependent control flow, so the traced graph is valid for any batch
+    size and number of frames.
+    """
+    with torch.no_grad():
+        mel = torch.randn(1, h.num_mels, example_frames, device=generator.conv_pre.weight.device)
+        traced = torch.jit.trace(generator, mel)
+    return torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+
+
+class CompiledGenerator(object):
+    """torch.compile()d generator that falls back to eager mode for good if compiling fails."""
+    def __init__(self, generator):
+        self.generator = generator
+        self.h = generator.h
+        self.compiled = torch.compile(generator, dynamic=True)
+
+    def __call__(self, x):
+        if self.compiled is not None:
+            try:
+                return self.compiled(x)
+            except Exception as e:
+                print('torch.compile failed ({}), running in eager mode'.format(e))
+                self.compiled = None
+        return self.generator(x)
+
+
+def load_compiled_generator(checkpoint_file, h, device, mode, cache_dir, fuse=False):
+    """Load the generator in `mode` 'script' (TorchScript) or 'inductor' (torch.compile).
+
+    Scripted artifacts are cached in cache_dir under compile_key(), so only the first process for a
+    given config, checkpoint and device type pays for compiling; inductor keeps its own cache there.
+    Any failure falls back to the eager generator. ONNX and already scripted artifacts are returned as
+    they are.
+    """
+    if is_onnx_generator(checkpoint_file) or scripted_generator_meta(checkpoint_file) is not None:
+        return load_inference_generator(checkpoint_file, h, device)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    if mode == 'inductor':
+        # Inductor keys its own cache entries by graph, device and torch version; the directory only
+        # keeps them together across processes.
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(cache_dir, 'inductor'))
+        return CompiledGenerator(load_inference_generator(checkpoint_file, h, device, fuse))
+
+    key = compile_key(checkpoint_file, h, device, fuse)
+    cache_file = os.path.join(cache_dir, 'generator_{}.pt'.format(key))
+    if os.path.isfile(cache_file):
+        try:
+            return load_scripted_generator(cache_file, device)
+        except Exception as e:
+            print('Could not load {} ({}), compiling again'.format(cache_file, e))
+    generator = load_inference_generator(checkpoint_file, h, device, fuse)
+    try:
+        scripted = script_generator(generator, h)
+        tmp_file = cache_file + '.tmp'
+        save_scripted_generator(scripted, h, tmp_file, 'torchscript')
+        os.replace(tmp_file, cache_file)
+        return load_scripted_generator(cache_file, device)
+    except Exception as e:
+        print('TorchScript compilation failed ({}), running in eager mode'.format(e))
+        return generator
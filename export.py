@@ -0,0 +1,153 @@
+import argparse
+import json
+import os
+import zipfile
+import torch
+from env import AttrDict
+from checkpoint import load_checkpoint, is_tensor_file, load_tensor_file, save_tensor_file
+from models import Generator
+from onnx_backend import is_onnx_generator, onnx_generator_config, export_onnx, check_onnx_parity, OnnxGenerator
+
+
+def export_generator(checkpoint_file, h, output_file, fp16=False):
+    """Write an inference-only generator: weight norm folded into the weights, config embedded.
+
+    The artifact is a tensor file holding {'config', 'generator'}; with `fp16` the weights are stored as
+    float16 and cast back to float32 when loaded.
+    """
+    generator = Generator(h)
+    generator.load_state_dict(load_checkpoint(checkpoint_file, 'cpu', keys=['generator'])['generator'])
+    generator.remove_weight_norm()
+    state_dict = generator.state_dict()
+    if fp16:
+        state_dict = {k: v.half() if v.is_floating_point() else v for k, v in state_dict.items()}
+    save_tensor_file(output_file, {'config': dict(h), 'generator': state_dict})
+
+
+def is_exported_generator(filepath):
+    return is_tensor_file(filepath) and 'config' in load_tensor_file(filepath)
+
+
+def exported_generator_config(filepath):
+    return AttrDict(load_tensor_file(filepath, keys=['config'])['config'])
+
+
+def load_exported_generator(filepath, device):
+    """Build a weight-norm-free Generator from an artifact written by export_generator."""
+    exported = load_tensor_file(filepath)
+    h = AttrDict(exported['config'])
+    generator = Generator(h, use_weight_norm=False)
+    generator.load_state_dict(exported['generator'])
+    return generator.to(device).eval(), h
+
+
+SCRIPTED_META = 'hifigan_generator.json'
+
+
+class ScriptedGenerator(torch.nn.Module):
+    """A TorchScript generator together with the config that the synthesis helpers read from `h`."""
+    def __init__(self, module, h):
+        super(ScriptedGenerator, self).__init__()
+        self.module = module
+        self.h = h
+
+    def forward(self, x):
+        return self.module(x)
+
+
+def save_scripted_generator(module, h, output_file, kind):
+    """torch.jit.save `module` with the config and the artifact `kind` (e.g. 'int8-static') embedded."""
+    meta = json.dumps({'config': dict(h), 'kind': kind})
+    torch.jit.save(module, output_file, _extra_files={SCRIPTED_META: meta})
+
+
+def scripted_generator_meta(filepath):
+    """The metadata saved by save_scripted_generator, or None for any other file."""
+    if not zipfile.is_zipfile(filepath):
+        return None
+    with zipfile.ZipFile(filepath) as z:
+        for name in z.namelist():
+            if name.endswith('/extra/' + SCRIPTED_META):
+                return json.loads(z.read(name).decode('utf-8'))
+    return None
+
+
+def load_scripted_generator(filepath, device):
+    meta = scripted_generator_meta(filepath)
+    module = torch.jit.load(filepath, map_location=device)
+    return ScriptedGenerator(module, AttrDict(meta['config'])).eval()
+
+
+def generator_config(filepath):
+    """The config embedded in an exported, scripted or ONNX generator, or None for a training checkpoint."""
+    if is_onnx_generator(filepath):
+        return onnx_generator_config(filepath)
+    if is_exported_generator(filepath):
+        return exported_generator_config(filepath)
+    meta = scripted_generator_meta(filepath)
+    return AttrDict(meta['config']) if meta is not None else None
+
+
+def requires_cpu(filepath):
+    """Whether the artifact only runs on CPU: quantized kernels or the onnxruntime CPU backend."""
+    if is_onnx_generator(filepath):
+        return True
+    meta = scripted_generator_meta(filepath)
+    return meta is not None and meta['kind'].startswith('int8')
+
+
+def load_inference_generator(checkpoint_file, h, device, fuse=False):
+    """Generator in eval mode without weight norm, from an exported artifact or a training checkpoint.
+
+    With `fuse` the generator is switched to its fused inference path (Generator.fuse). Scripted
+    artifacts (see save_scripted_generator) are loaded as they were saved, and .onnx files run through
+    onnxruntime.
+    """
+    if is_onnx_generator(checkpoint_file):
+        return OnnxGenerator(checkpoint_file)
+    if scripted_generator_meta(checkpoint_file) is not None:
+        return load_scripted_generator(checkpoint_file, device)
+    if is_exported_generator(checkpoint_file):
+        generator = load_exported_generator(checkpoint_file, device)[0]
+    else:
+        generator = Generator(h).to(device)
+        state_dict_g = load_checkpoint(checkpoint_file, device, keys=['generator'])
+        generator.load_state_dict(state_dict_g['generator'])
+        generator.eval()
+        generator.remove_weight_norm()
+    if fuse:
+        generator.fuse()
+    return generator
+
+
+def main():
+    print('Exporting generator..')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint_file', required=True)
+    parser.add_argument('--output_file', required=True)
+    parser.add_argument('--config', default=None)
+    parser.add_argument('--fp16', action='store_true')
+    parser.add_argument('--format', default='tensor', choices=['tensor', 'onnx'])
+    parser.add_argument('--opset_version', default=17, type=int)
+    a = parser.parse_args()
+
+    config_file = a.config or os.path.join(os.path.split(a.checkpoint_file)[0], 'config.json')
+    with open(config_file) as f:
+        data = f.read()
+
+    json_config = json.loads(data)
+    h = AttrDict(json_config)
+
+    if a.format == 'onnx':
+        generator = load_inference_generator(a.checkpoint_file, h, 'cpu')
+        export_onnx(generator, h, a.output_file, a.opset_version)
+        print('Max. abs. difference to torch : {:.2e}'.format(check_onnx_parity(generator, a.output_file,
+                                                                                h.num_mels)))
+    else:
+        export_generator(a.checkpoint_file, h, a.output_file, a.fp16)
+    print('Wrote {}'.format(a.output_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,25 +7,19 @@ import json
 import torch
 from scipy.io.wavfile import write
 from env import AttrDict
-from meldataset import mel_spectrogram, MAX_WAV_VALUE, load_wav
-from models import Generator
+from meldataset import mel_spectrogram, mel_frontend, MAX_WAV_VALUE, load_wav, resample_audio
+from export import load_inference_generator, generator_config, requires_cpu
+from compiled import load_compiled_generator
+from manifest import read_wav_header
+from resample_cache import ResampleCache
+from synthesis import length_batches, vocode, vocode_chunked, run_pipeline
 import random
-from scipy.signal import resample
 import time
-from torchaudio import transforms
 
 h = None
 device = None
 
 
-def load_checkpoint(filepath, device):
-    assert os.path.isfile(filepath)
-    print("Loading '{}'".format(filepath))
-    checkpoint_dict = torch.load(filepath, map_location=device)
-    print("Complete.")
-    return checkpoint_dict
-
-
 def get_mel(x):
     return mel_spectrogram(x, h.n_fft, h.num_mels, h.sampling_rate, h.hop_size, h.win_size, h.fmin, h.fmax)
 
@@ -38,62 +32,91 @@ def scan_checkpoint(cp_dir, prefix):
     return sorted(cp_list)[-1]
 
 
+def load_segment(path, resample_cache, crop=True):
+    if resample_cache is not None:
+        wav = resample_cache.load(path)
+    else:
+        wav, sr = load_wav(path)
+        wav = wav / MAX_WAV_VALUE
+        wav = resample_audio(wav, sr, h.sampling_rate)
+
+    wav = torch.FloatTensor(wav)
+    wav = wav.unsqueeze(0)
+
+    if crop and wav.size(1) >= h.segment_size:
+        max_audio_start = wav.size(1) - h.segment_size
+        audio_start = random.randint(0, max_audio_start)
+        wav = wav[:, audio_start:audio_start + h.segment_size]
+    return wav.pin_memory() if device.type == 'cuda' else wav
+
+
+def estimate_frames(path, crop=True):
+    """Mel length of a wav file after resampling and cropping, from its header alone."""
+    frames, sr, _ = read_wav_header(path)
+    samples = int(frames * h.sampling_rate / sr)
+    if crop:
+        samples = min(samples, h.segment_size)
+    return samples // h.hop_size
+
+
 def inference(a):
-    mel_spec = transforms.MelSpectrogram(sample_rate=h.sampling_rate,
-                                         n_fft=h.n_fft,
-                                         win_length=h.win_size,
-                                         pad=int((h.n_fft - h.hop_size) / 2),
-                                         pad_mode="reflect",
-                                         hop_length=h.hop_size,
-                                         f_min=h.fmin,
-                                         f_max=h.fmax,
-                                         n_mels=h.num_mels,
-                                         window_fn=torch.hann_window,
-                                         power=2,
-                                         normalized=False,
-                                         center=False,
-                                         onesided=True).to(device)
-    generator = Generator(h).to(device)
-
-    state_dict_g = load_checkpoint(a.checkpoint_file, device)
-    generator.load_state_dict(state_dict_g['generator'])
+    mel_spec = mel_frontend(h.n_fft, h.num_mels, h.sampling_rate, h.hop_size, h.win_size, h.fmin, h.fmax,
+                            device=device)
+    if a.compile != 'none':
+        generator = load_compiled_generator(a.checkpoint_file, h, device, a.compile, a.compile_cache_dir, a.fused)
+    else:
+        generator = load_inference_generator(a.checkpoint_file, h, device, a.fused)
 
     filelist = os.listdir(a.input_wavs_dir)
 
     os.makedirs(a.output_dir, exist_ok=True)
 
-    generator.eval()
-    generator.remove_weight_norm()
-    with torch.no_grad():
-        for i, filname in enumerate(filelist):
-            wav, sr = load_wav(os.path.join(a.input_wavs_dir, filname))
-            wav = wav / MAX_WAV_VALUE
+    resample_cache = ResampleCache(a.resample_cache_dir, h.sampling_rate) if a.resample_cache_dir else None
 
-            if sr != h.sampling_rate:
-                number_of_samples = round(len(wav) * float(h.sampling_rate) / sr)
-                wav = resample(wav, number_of_samples)
+    # Chunked synthesis has bounded memory for any length, so whole files are vocoded instead of a crop.
+    crop = a.chunk_frames == 0
+    if a.batch_frames > 0:
+        lengths = [estimate_frames(os.path.join(a.input_wavs_dir, filname), crop) for filname in filelist]
+        batches = length_batches(lengths, a.batch_frames, a.max_batch_size)
+    else:
+        batches = [[i] for i in range(len(filelist))]
 
-            wav = torch.FloatTensor(wav).to(device)
-            wav = wav.unsqueeze(0)
+    def read(batch):
+        return batch, [load_segment(os.path.join(a.input_wavs_dir, filelist[i]), resample_cache, crop)
+                       for i in batch]
 
-            if wav.size(1) >= h.segment_size:
-                max_audio_start = wav.size(1) - h.segment_size
-                audio_start = random.randint(0, max_audio_start)
-                wav = wav[:, audio_start:audio_start + h.segment_size]
+    num_samples = 0
 
+    def compute(data):
+        nonlocal num_samples
+        batch, wavs = data
+        with torch.no_grad():
             # x = get_mel(wav)
-            x = mel_spec(wav)
+            mels = [mel_spec(wav.to(device, non_blocking=True))[0] for wav in wavs]
             current = time.time()
-            y_g_hat = generator(x)
+            if a.chunk_frames > 0:
+                audios = [vocode_chunked(generator, mel, a.chunk_frames) for mel in mels]
+            else:
+                audios = vocode(generator, mels)
             print(time.time() - current)
-            audio = y_g_hat.squeeze()
+        num_samples += sum(len(audio) for audio in audios)
+        return batch, [audio.cpu() for audio in audios]
+
+    def write_batch(result):
+        for i, audio in zip(*result):
             audio = audio * MAX_WAV_VALUE
-            audio = audio.cpu().numpy().astype('int16')
+            audio = audio.numpy().astype('int16')
 
-            output_file = os.path.join(a.output_dir, os.path.splitext(filname)[0] + '_generated.wav')
+            output_file = os.path.join(a.output_dir, os.path.splitext(filelist[i])[0] + '_generated.wav')
             write(output_file, h.sampling_rate, audio)
             print(output_file)
 
+    start = time.time()
+    run_pipeline(batches, read, compute, write_batch, a.num_readers, a.num_writers)
+    elapsed = time.time() - start
+    print('Vocoded {} files, {:.1f} s of audio in {:.1f} s ({:.1f}x real-time)'.format(
+        len(filelist), num_samples / h.sampling_rate, elapsed, num_samples / h.sampling_rate / elapsed))
+
 
 def main():
     print('Initializing Inference Process..')
@@ -102,19 +125,30 @@ def main():
     parser.add_argument('--input_wavs_dir', default='test_files')
     parser.add_argument('--output_dir', default='generated_files')
     parser.add_argument('--checkpoint_file', required=True)
+    parser.add_argument('--resample_cache_dir', default=None)
+    parser.add_argument('--batch_frames', default=0, type=int)
+    parser.add_argument('--max_batch_size', default=None, type=int)
+    parser.add_argument('--num_readers', default=2, type=int)
+    parser.add_argument('--num_writers', default=2, type=int)
+    parser.add_argument('--chunk_frames', default=0, type=int)
+    parser.add_argument('--fused', action='store_true')
+    parser.add_argument('--compile', default='none', choices=['none', 'script', 'inductor'])
+    parser.add_argument('--compile_cache_dir', default='compiled_generators')
     a = parser.parse_args()
 
-    config_file = os.path.join(os.path.split(a.checkpoint_file)[0], 'config.json')
-    with open(config_file) as f:
-        data = f.read()
-
     global h
-    json_config = json.loads(data)
-    h = AttrDict(json_config)
+    h = generator_config(a.checkpoint_file)
+    if h is None:
+        config_file = os.path.join(os.path.split(a.checkpoint_file)[0], 'config.json')
+        with open(config_file) as f:
+            data = f.read()
+
+        json_config = json.loads(data)
+        h = AttrDict(json_config)
 
     torch.manual_seed(h.seed)
     global device
-    if torch.cuda.is_available():
+    if torch.cuda.is_available() and not requires_cpu(a.checkpoint_file):
         torch.cuda.manual_seed(h.seed)
         device = torch.device('cuda')
     else:
@@ -5,24 +5,19 @@ import os
 import numpy as np
 import argparse
 import json
+import time
 import torch
 from scipy.io.wavfile import write
 from env import AttrDict
 from meldataset import MAX_WAV_VALUE
-from models import Generator
+from synthesis import length_batches, vocode, vocode_chunked, run_pipeline
+from export import load_inference_generator, generator_config, requires_cpu
+from compiled import load_compiled_generator
 
 h = None
 device = None
 
 
-def load_checkpoint(filepath, device):
-    assert os.path.isfile(filepath)
-    print("Loading '{}'".format(filepath))
-    checkpoint_dict = torch.load(filepath, map_location=device)
-    print("Complete.")
-    return checkpoint_dict
-
-
 def scan_checkpoint(cp_dir, prefix):
     pattern = os.path.join(cp_dir, prefix + '*')
     cp_list = glob.glob(pattern)
@@ -32,30 +27,58 @@ def scan_checkpoint(cp_dir, prefix):
 
 
 def inference(a):
-    generator = Generator(h).to(device)
-
-    state_dict_g = load_checkpoint(a.checkpoint_file, device)
-    generator.load_state_dict(state_dict_g['generator'])
+    if a.compile != 'none':
+        generator = load_compiled_generator(a.checkpoint_file, h, device, a.compile, a.compile_cache_dir, a.fused)
+    else:
+        generator = load_inference_generator(a.checkpoint_file, h, device, a.fused)
 
     filelist = os.listdir(a.input_mels_dir)
 
     os.makedirs(a.output_dir, exist_ok=True)
 
-    generator.eval()
-    generator.remove_weight_norm()
-    with torch.no_grad():
-        for i, filname in enumerate(filelist):
-            x = np.load(os.path.join(a.input_mels_dir, filname))
-            x = torch.FloatTensor(x).to(device)
-            y_g_hat = generator(x)
-            audio = y_g_hat.squeeze()
+    if a.batch_frames > 0:
+        lengths = [np.load(os.path.join(a.input_mels_dir, filname), mmap_mode='r').shape[-1] for filname in filelist]
+        batches = length_batches(lengths, a.batch_frames, a.max_batch_size)
+    else:
+        batches = [[i] for i in range(len(filelist))]
+
+    def read(batch):
+        mels = []
+        for i in batch:
+            x = torch.FloatTensor(np.load(os.path.join(a.input_mels_dir, filelist[i])))
+            x = x.reshape(x.size(-2), x.size(-1))
+            mels.append(x.pin_memory() if device.type == 'cuda' else x)
+        return batch, mels
+
+    num_samples = 0
+
+    def compute(data):
+        nonlocal num_samples
+        batch, mels = data
+        with torch.no_grad():
+            mels = [x.to(device, non_blocking=True) for x in mels]
+            if a.chunk_frames > 0:
+                audios = [vocode_chunked(generator, mel, a.chunk_frames) for mel in mels]
+            else:
+                audios = vocode(generator, mels)
+        num_samples += sum(len(audio) for audio in audios)
+        return batch, [audio.cpu() for audio in audios]
+
+    def write_batch(result):
+        for i, audio in zip(*result):
             audio = audio * MAX_WAV_VALUE
-            audio = audio.cpu().numpy().astype('int16')
+            audio = audio.numpy().astype('int16')
 
-            output_file = os.path.join(a.output_dir, os.path.splitext(filname)[0] + '_generated_e2e.wav')
+            output_file = os.path.join(a.output_dir, os.path.splitext(filelist[i])[0] + '_generated_e2e.wav')
             write(output_file, h.sampling_rate, audio)
             print(output_file)
 
+    start = time.time()
+    run_pipeline(batches, read, compute, write_batch, a.num_readers, a.num_writers)
+    elapsed = time.time() - start
+    print('Vocoded {} files, {:.1f} s of audio in {:.1f} s ({:.1f}x real-time)'.format(
+        len(filelist), num_samples / h.sampling_rate, elapsed, num_samples / h.sampling_rate / elapsed))
+
 
 def main():
     print('Initializing Inference Process..')
@@ -64,19 +87,29 @@ def main():
     parser.add_argument('--input_mels_dir', default='test_mel_files')
     parser.add_argument('--output_dir', default='generated_files_from_mel')
     parser.add_argument('--checkpoint_file', required=True)
+    parser.add_argument('--batch_frames', default=0, type=int)
+    parser.add_argument('--max_batch_size', default=None, type=int)
+    parser.add_argument('--num_readers', default=2, type=int)
+    parser.add_argument('--num_writers', default=2, type=int)
+    parser.add_argument('--chunk_frames', default=0, type=int)
+    parser.add_argument('--fused', action='store_true')
+    parser.add_argument('--compile', default='none', choices=['none', 'script', 'inductor'])
+    parser.add_argument('--compile_cache_dir', default='compiled_generators')
     a = parser.parse_args()
 
-    config_file = os.path.join(os.path.split(a.checkpoint_file)[0], 'config.json')
-    with open(config_file) as f:
-        data = f.read()
-
     global h
-    json_config = json.loads(data)
-    h = AttrDict(json_config)
+    h = generator_config(a.checkpoint_file)
+    if h is None:
+        config_file = os.path.join(os.path.split(a.checkpoint_file)[0], 'config.json')
+        with open(config_file) as f:
+            data = f.read()
+
+        json_config = json.loads(data)
+        h = AttrDict(json_config)
 
     torch.manual_seed(h.seed)
     global device
-    if torch.cuda.is_available():
+    if torch.cuda.is_available() and not requires_cpu(a.checkpoint_file):
         torch.cuda.manual_seed(h.seed)
         device = torch.device('cuda')
     else:
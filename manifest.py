@@ -0,0 +1,148 @@
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import random
+import struct
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from env import AttrDict
+
+MANIFEST_VERSION = 1
+
+
+def read_wav_header(path):
+    """Return (frames, sampling_rate, channels) of a RIFF/WAVE file without reading its samples."""
+    with open(path, 'rb') as f:
+        riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError("{} is not a RIFF/WAVE file".format(path))
+        block_align = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                raise ValueError("{} has no data chunk".format(path))
+            chunk_id, size = struct.unpack('<4sI', chunk)
+            if chunk_id == b'fmt ':
+                _, channels, sampling_rate, _, block_align = struct.unpack('<HHIIH', f.read(14))
+                f.seek(size - 14 + size % 2, os.SEEK_CUR)
+            elif chunk_id == b'data':
+                if block_align is None:
+                    raise ValueError("{} has no fmt chunk before its data chunk".format(path))
+                return size // block_align, sampling_rate, channels
+            else:
+                f.seek(size + size % 2, os.SEEK_CUR)
+
+
+def class_dirs(base_pth, cls_pth):
+    """Yield the leaf directories of the cls_pth tree, spelled the way recursive_file_extract does."""
+    for key in cls_pth:
+        if isinstance(cls_pth[key], Mapping):
+            for fd in class_dirs(base_pth + key + '/', cls_pth[key]):
+                yield fd
+        else:
+            for child in cls_pth[key]:
+                yield base_pth + key + '/' + child + '/'
+
+
+def _scan_dir(fd):
+    if not os.path.isdir(fd):
+        return []
+    with os.scandir(fd) as it:
+        return [entry.path for entry in it if entry.is_file()]
+
+
+def _describe(path):
+    try:
+        frames, sampling_rate, channels = read_wav_header(path)
+    except (ValueError, struct.error) as e:
+        print('Skipping {}: {}'.format(path, e))
+        return None
+    return {'path': path, 'frames': frames, 'sampling_rate': sampling_rate, 'channels': channels}
+
+
+def config_fingerprint(h):
+    """Hash of the config entries that decide which files a manifest holds and how they are split."""
+    keys = {k: h.get(k) for k in ('base_pth', 'cls_pth', 'num_validation', 'seed')}
+    return hashlib.sha1(json.dumps(keys, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def build_manifest(h, num_workers=32):
+    """Scan the dataset directories of `h` and return (header, entries) with a seeded train/validation split."""
+    bases = [h.base_pth] if isinstance(h.base_pth, str) else h.base_pth
+    dirs = [fd for base in bases for fd in class_dirs(base, h.cls_pth)]
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        files = sorted(itertools.chain.from_iterable(executor.map(_scan_dir, dirs)))
+        entries = [e for e in executor.map(_describe, files) if e is not None]
+
+    random.Random(h.seed).shuffle(entries)
+    n_training = int(len(entries) * (1 - h.num_validation))
+    for i, entry in enumerate(entries):
+        entry['split'] = 'train' if i < n_training else 'validation'
+
+    header = {'version': MANIFEST_VERSION, 'config': config_fingerprint(h), 'num_files': len(entries)}
+    return header, entries
+
+
+def write_manifest(path, header, entries):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(json.dumps(header) + '\n')
+        for entry in entries:
+            f.write(json.dumps(entry) + '\n')
+    os.replace(tmp_path, path)
+
+
+def load_manifest(path):
+    with open(path, encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if header.get('version') != MANIFEST_VERSION:
+            raise ValueError("{} has manifest version {}, expected {}".format(
+                path, header.get('version'), MANIFEST_VERSION))
+        entries = [json.loads(line) for line in f if len(line.strip()) > 0]
+    return header, entries
+
+
+def get_manifest(path, h):
+    """Load the manifest at `path`, (re)building it when missing or written for a different dataset config."""
+    if os.path.isfile(path):
+        header, entries = load_manifest(path)
+        if header['config'] == config_fingerprint(h):
+            return entries
+        print('Manifest {} does not match the config, rebuilding'.format(path))
+    header, entries = build_manifest(h)
+    write_manifest(path, header, entries)
+    print('Wrote manifest of {} files to {}'.format(len(entries), path))
+    return entries
+
+
+def manifest_filelists(entries):
+    training_files = [e['path'] for e in entries if e['split'] == 'train']
+    validation_files = [e['path'] for e in entries if e['split'] == 'validation']
+    return training_files, validation_files
+
+
+def main():
+    print('Building dataset manifest..')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', required=True)
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--num_workers', default=32, type=int)
+    a = parser.parse_args()
+
+    with open(a.config) as f:
+        data = f.read()
+
+    json_config = json.loads(data)
+    h = AttrDict(json_config)
+
+    header, entries = build_manifest(h, a.num_workers)
+    write_manifest(a.output, header, entries)
+    print('Wrote manifest of {} files to {}'.format(len(entries), a.output))
+
+
+if __name__ == '__main__':
+    main()
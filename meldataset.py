@@ -1,3 +1,5 @@
+import functools
+import hashlib
 import math
 import os
 import random
@@ -6,7 +8,7 @@ import torch.utils.data
 import numpy as np
 from librosa.util import normalize
 from scipy.io.wavfile import read
-from scipy.signal import resample
+from scipy.signal import firwin, resample, resample_poly
 from librosa.filters import mel as librosa_mel_fn
 from collections.abc import Mapping
 from torchaudio import transforms
@@ -19,6 +21,25 @@ def load_wav(full_path):
     return data, sampling_rate
 
 
+@functools.lru_cache(maxsize=None)
+def polyphase_filter(up, down):
+    """Anti-aliasing FIR filter of scipy's resample_poly, designed once per rate pair."""
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    return firwin(2 * half_len + 1, 1. / max_rate, window=('kaiser', 5.0))
+
+
+def resample_audio(audio, orig_sr, target_sr, mode='fft'):
+    if orig_sr == target_sr:
+        return audio
+    if mode == 'poly':
+        g = math.gcd(int(orig_sr), int(target_sr))
+        up, down = int(target_sr) // g, int(orig_sr) // g
+        return resample_poly(audio, up, down, window=polyphase_filter(up, down))
+    number_of_samples = round(len(audio) * float(target_sr) / orig_sr)
+    return resample(audio, number_of_samples)
+
+
 def dynamic_range_compression(x, C=1, clip_val=1e-5):
     return np.log(np.clip(x, a_min=clip_val, a_max=None) * C)
 
@@ -47,32 +68,84 @@ def spectral_de_normalize_torch(magnitudes):
 
 mel_basis = {}
 hann_window = {}
+mel_frontends = {}
 
 
-def mel_spectrogram(y, n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center=False):
-    if torch.min(y) < -1.:
-        print('min value is ', torch.min(y))
-    if torch.max(y) > 1.:
-        print('max value is ', torch.max(y))
+def mel_spectrogram(y, n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, center=False,
+                    check_range=False):
+    if check_range:
+        if torch.min(y) < -1.:
+            print('min value is ', torch.min(y))
+        if torch.max(y) > 1.:
+            print('max value is ', torch.max(y))
 
     global mel_basis, hann_window
-    if fmax not in mel_basis:
+    mel_key = '{}_{}_{}_{}_{}_{}'.format(sampling_rate, n_fft, num_mels, fmin, fmax, y.device)
+    window_key = '{}_{}'.format(win_size, y.device)
+    if mel_key not in mel_basis:
         mel = librosa_mel_fn(sr=sampling_rate, n_fft=n_fft, n_mels=num_mels, fmin=fmin, fmax=fmax)
-        mel_basis[str(fmax)+'_'+str(y.device)] = torch.from_numpy(mel).float().to(y.device)
-        hann_window[str(y.device)] = torch.hann_window(win_size).to(y.device)
+        mel_basis[mel_key] = torch.from_numpy(mel).float().to(y.device)
+    if window_key not in hann_window:
+        hann_window[window_key] = torch.hann_window(win_size).to(y.device)
 
     y = torch.nn.functional.pad(y.unsqueeze(1), (int((n_fft-hop_size)/2), int((n_fft-hop_size)/2)), mode='reflect')
     y = y.squeeze(1)
 
-    spec = torch.stft(y, n_fft, hop_length=hop_size, win_length=win_size, window=hann_window[str(y.device)],
+    spec = torch.stft(y, n_fft, hop_length=hop_size, win_length=win_size, window=hann_window[window_key],
                       center=center, pad_mode='reflect', normalized=False, onesided=True, return_complex=True)
     spec = torch.view_as_real(spec)
     spec = torch.sqrt(spec.pow(2).sum(-1)+(1e-9))
-    spec = torch.matmul(mel_basis[str(fmax)+'_'+str(y.device)], spec)
+    spec = torch.matmul(mel_basis[mel_key], spec)
     spec = spectral_normalize_torch(spec)
     return spec
 
 
+class MelFrontend(torch.nn.Module):
+    """The power mel spectrogram used for generator inputs and the mel loss."""
+    def __init__(self, n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, check_range=False):
+        super(MelFrontend, self).__init__()
+        self.check_range = check_range
+        self.mel_spec = transforms.MelSpectrogram(sample_rate=sampling_rate,
+                                                  n_fft=n_fft,
+                                                  pad=int((n_fft-hop_size)/2),
+                                                  pad_mode="reflect",
+                                                  win_length=win_size,
+                                                  hop_length=hop_size,
+                                                  f_min=fmin,
+                                                  f_max=fmax,
+                                                  n_mels=num_mels,
+                                                  window_fn=torch.hann_window,
+                                                  power=2,
+                                                  normalized=False,
+                                                  center=False,
+                                                  onesided=True)
+
+    def forward(self, y):
+        if self.check_range:
+            if torch.min(y) < -1.:
+                print('min value is ', torch.min(y))
+            if torch.max(y) > 1.:
+                print('max value is ', torch.max(y))
+        return self.mel_spec(y)
+
+
+def mel_frontend(n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax, device='cpu',
+                 dtype=torch.float32, check_range=False):
+    """Return the process-wide MelFrontend for these parameters, building the filterbank and window once.
+
+    Frontends are cached by (config hash, device, dtype); range checking forces a device sync and is
+    therefore opt-in.
+    """
+    global mel_frontends
+    config = (n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax)
+    config_hash = hashlib.sha1(repr(config).encode('utf-8')).hexdigest()
+    key = (config_hash, str(torch.device(device)), dtype, check_range)
+    if key not in mel_frontends:
+        frontend = MelFrontend(*config, check_range=check_range)
+        mel_frontends[key] = frontend.to(device=device, dtype=dtype)
+    return mel_frontends[key]
+
+
 def recursive_file_extract(base_pth, cls_pth, cls_queue=[]):
     i = 0
     filename_list = []
@@ -80,7 +153,7 @@ def recursive_file_extract(base_pth, cls_pth, cls_queue=[]):
         if isinstance(cls_pth[key], Mapping):
             cls_queue.append(i)
             flist, llist = recursive_file_extract(base_pth + key + '/', cls_pth[key], cls_queue)
-            filename_list = filename_list + flist
+            filename_list.extend(flist)
             cls_queue = []
         else:
             j = 0
@@ -88,7 +161,7 @@ def recursive_file_extract(base_pth, cls_pth, cls_queue=[]):
                 fd = base_pth + key + '/' + child + '/'
                 if os.path.isdir(fd):
                     filenames = [os.path.join(fd, f) for f in os.listdir(fd) if os.path.isfile(os.path.join(fd, f))]
-                    filename_list = filename_list + filenames
+                    filename_list.extend(filenames)
                 j = j + 1
         i = i + 1
     return filename_list
@@ -120,8 +193,9 @@ def get_dataset_filelist(h):
 
 class MelDataset(torch.utils.data.Dataset):
     def __init__(self, training_files, segment_size, n_fft, num_mels,
-                 hop_size, win_size, sampling_rate,  fmin, fmax, split=True, shuffle=True, n_cache_reuse=1,
-                 device=None, fmax_loss=None, fine_tuning=False, base_mels_path=None):
+                 hop_size, win_size, sampling_rate,  fmin, fmax, split=True, shuffle=True, audio_cache=None,
+                 device=None, fmax_loss=None, fine_tuning=False, base_mels_path=None, audio_store=None,
+                 resample_cache=None, compute_mel=True, mel_store=None):
         self.audio_files = training_files
         random.seed(1234)
         if shuffle:
@@ -136,85 +210,112 @@ class MelDataset(torch.utils.data.Dataset):
         self.fmin = fmin
         self.fmax = fmax
         self.fmax_loss = fmax_loss
-        self.cached_wav = None
-        self.n_cache_reuse = n_cache_reuse
-        self._cache_ref_count = 0
+        self.audio_cache = audio_cache
         self.device = device
         self.fine_tuning = fine_tuning
         self.base_mels_path = base_mels_path
-        self.mel_spec = transforms.MelSpectrogram(sample_rate=sampling_rate,
-                                                  n_fft=n_fft,
-                                                  pad=int((n_fft-hop_size)/2),
-                                                  pad_mode="reflect",
-                                                  win_length=win_size,
-                                                  hop_length=hop_size,
-                                                  f_min=fmin,
-                                                  f_max=fmax,
-                                                  n_mels=num_mels,
-                                                  window_fn=torch.hann_window,
-                                                  power=2,
-                                                  normalized=False,
-                                                  center=False,
-                                                  onesided=True)
+        self.audio_store = audio_store
+        self.mel_store = mel_store
+        self.resample_cache = resample_cache
+        # With compute_mel=False only audio crops (and fine-tuning mels) are returned and the caller
+        # computes mels batch-wise; the mel slots of the returned tuple then hold empty tensors.
+        self.compute_mel = compute_mel
+        self.mel_spec = mel_frontend(n_fft, num_mels, sampling_rate, hop_size, win_size, fmin, fmax)
+
+    def _audio_source(self, filename):
+        """Return the length of an utterance and a reader for its [start, end) window."""
+        if self.audio_store is not None and filename in self.audio_store:
+            store = self.audio_store
+            return store.length(filename), lambda start, end: store.read(filename, start, end) / MAX_WAV_VALUE
+
+        if self.audio_cache is not None:
+            audio = self.audio_cache.get(filename)
+            if audio is None:
+                audio = self.audio_cache.put(filename, self._load_audio(filename))
+            scale = self.audio_cache.scale
+            return len(audio), lambda start, end: audio[start:end] * scale
+
+        audio = self._load_audio(filename)
+        return len(audio), lambda start, end: audio[start:end]
+
+    def _load_audio(self, filename):
+        if self.resample_cache is not None:
+            return self.resample_cache.load(filename)
+        audio, sampling_rate = load_wav(filename)
+        audio = audio / MAX_WAV_VALUE
+        # if not self.fine_tuning:
+        #     audio = normalize(audio) * 0.95
+        # Make sure all have the sample rate.
+        return resample_audio(audio, sampling_rate, self.sampling_rate)
+
+    def _mel_source(self, filename):
+        """Return the frame count of an utterance's precomputed mel and a reader for its [start, end) frames.
+
+        The reader returns a (1, num_mels, frames) tensor; only the requested frames are read from disk.
+        """
+        name = os.path.splitext(os.path.split(filename)[-1])[0]
+        if self.mel_store is not None and name in self.mel_store:
+            store = self.mel_store
+            read = lambda start, end: store.read(name, start, end)
+            mel_len = store.length(name)
+        else:
+            mel = np.load(os.path.join(self.base_mels_path, name + '.npy'), mmap_mode='r')
+            read = lambda start, end: np.array(mel[..., start:end])
+            mel_len = mel.shape[-1]
+
+        def read_mel(start, end):
+            mel = read(start, end)
+            return torch.from_numpy(mel.reshape(1, mel.shape[-2], mel.shape[-1]))
+        return mel_len, read_mel
 
     def __getitem__(self, index):
         filename = self.audio_files[index]
-        if self._cache_ref_count == 0:
-            audio, sampling_rate = load_wav(filename)
-            audio = audio / MAX_WAV_VALUE
-            # if not self.fine_tuning:
-            #     audio = normalize(audio) * 0.95
-            self.cached_wav = audio
-            if sampling_rate != self.sampling_rate:
-                number_of_samples = round(len(audio) * float(self.sampling_rate) / sampling_rate)
-                audio = resample(audio, number_of_samples)  # Make sure all have the sample rate.
-                # raise ValueError("{} SR doesn't match target {} SR".format(
-                #     sampling_rate, self.sampling_rate))
-            self._cache_ref_count = self.n_cache_reuse
-        else:
-            audio = self.cached_wav
-            self._cache_ref_count -= 1
-
-        audio = torch.FloatTensor(audio)
-        audio = audio.unsqueeze(0)
+        return self.make_item(filename, *self._audio_source(filename))
 
+    def make_item(self, filename, audio_len, read_audio):
+        """Crop an utterance and compute its mels, reading audio only through `read_audio(start, end)`."""
         if not self.fine_tuning:
-            if self.split:
-                if audio.size(1) >= self.segment_size:
-                    max_audio_start = audio.size(1) - self.segment_size
-                    audio_start = random.randint(0, max_audio_start)
-                    audio = audio[:, audio_start:audio_start+self.segment_size]
-                else:
-                    audio = torch.nn.functional.pad(audio, (0, self.segment_size - audio.size(1)), 'constant')
+            if self.split and audio_len >= self.segment_size:
+                max_audio_start = audio_len - self.segment_size
+                audio_start = random.randint(0, max_audio_start)
+                audio = read_audio(audio_start, audio_start+self.segment_size)
+            else:
+                audio = read_audio(0, audio_len)
+            audio = torch.FloatTensor(audio)
+            audio = audio.unsqueeze(0)
+
+            if self.split and audio.size(1) < self.segment_size:
+                audio = torch.nn.functional.pad(audio, (0, self.segment_size - audio.size(1)), 'constant')
 
             # mel = mel_spectrogram(audio, self.n_fft, self.num_mels,
             #                       self.sampling_rate, self.hop_size, self.win_size, self.fmin, self.fmax,
             #                       center=False)
-            mel = self.mel_spec(audio)
+            mel = self.mel_spec(audio) if self.compute_mel else torch.zeros(0)
         else:
-            mel = np.load(
-                os.path.join(self.base_mels_path, os.path.splitext(os.path.split(filename)[-1])[0] + '.npy'))
-            mel = torch.from_numpy(mel)
-
-            if len(mel.shape) < 3:
-                mel = mel.unsqueeze(0)
+            mel_len, read_mel = self._mel_source(filename)
 
             if self.split:
                 frames_per_seg = math.ceil(self.segment_size / self.hop_size)
 
-                if audio.size(1) >= self.segment_size:
-                    mel_start = random.randint(0, mel.size(2) - frames_per_seg - 1)
-                    mel = mel[:, :, mel_start:mel_start + frames_per_seg]
-                    audio = audio[:, mel_start * self.hop_size:(mel_start + frames_per_seg) * self.hop_size]
+                if audio_len >= self.segment_size:
+                    mel_start = random.randint(0, mel_len - frames_per_seg - 1)
+                    mel = read_mel(mel_start, mel_start + frames_per_seg)
+                    audio = read_audio(mel_start * self.hop_size, (mel_start + frames_per_seg) * self.hop_size)
+                    audio = torch.FloatTensor(audio).unsqueeze(0)
                 else:
+                    mel = read_mel(0, mel_len)
                     mel = torch.nn.functional.pad(mel, (0, frames_per_seg - mel.size(2)), 'constant')
+                    audio = torch.FloatTensor(read_audio(0, audio_len)).unsqueeze(0)
                     audio = torch.nn.functional.pad(audio, (0, self.segment_size - audio.size(1)), 'constant')
+            else:
+                mel = read_mel(0, mel_len)
+                audio = torch.FloatTensor(read_audio(0, audio_len)).unsqueeze(0)
 
         # mel_loss = mel_spectrogram(audio, self.n_fft, self.num_mels,
         #                            self.sampling_rate, self.hop_size, self.win_size, self.fmin, self.fmax_loss,
         #                            center=False)
 
-        mel_loss = self.mel_spec(audio)
+        mel_loss = self.mel_spec(audio) if self.compute_mel else torch.zeros(0)
 
         return (mel.squeeze(), audio.squeeze(0), filename, mel_loss.squeeze())
 
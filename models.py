@@ -1,3 +1,5 @@
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
@@ -6,12 +8,19 @@ from torch.nn.utils import weight_norm, remove_weight_norm, spectral_norm
 from utils import init_weights, get_padding
 
 LRELU_SLOPE = 0.1
+_weight_norm = weight_norm
+
+
+def _no_norm(module):
+    return module
 
 
 class ResBlock1(torch.nn.Module):
-    def __init__(self, h, channels, kernel_size=3, dilation=(1, 3, 5)):
+    def __init__(self, h, channels, kernel_size=3, dilation=(1, 3, 5), use_weight_norm=True):
         super(ResBlock1, self).__init__()
         self.h = h
+        self.use_weight_norm = use_weight_norm
+        weight_norm = _weight_norm if use_weight_norm else _no_norm
         self.convs1 = nn.ModuleList([
             weight_norm(Conv1d(channels, channels, kernel_size, 1, dilation=dilation[0],
                                padding=get_padding(kernel_size, dilation[0]))),
@@ -32,16 +41,23 @@ class ResBlock1(torch.nn.Module):
         ])
         self.convs2.apply(init_weights)
 
-    def forward(self, x):
+    def forward(self, x, inplace=False):
         for c1, c2 in zip(self.convs1, self.convs2):
             xt = F.leaky_relu(x, LRELU_SLOPE)
             xt = c1(xt)
-            xt = F.leaky_relu(xt, LRELU_SLOPE)
+            xt = F.leaky_relu(xt, LRELU_SLOPE, inplace)
             xt = c2(xt)
-            x = xt + x
+            x = xt.add_(x) if inplace else xt + x
         return x
 
+    def layers(self):
+        """The convolutions of each residual unit, in application order."""
+        return list(zip(self.convs1, self.convs2))
+
     def remove_weight_norm(self):
+        if not self.use_weight_norm:
+            return
+        self.use_weight_norm = False
         for l in self.convs1:
             remove_weight_norm(l)
         for l in self.convs2:
@@ -49,9 +65,11 @@ class ResBlock1(torch.nn.Module):
 
 
 class ResBlock2(torch.nn.Module):
-    def __init__(self, h, channels, kernel_size=3, dilation=(1, 3)):
+    def __init__(self, h, channels, kernel_size=3, dilation=(1, 3), use_weight_norm=True):
         super(ResBlock2, self).__init__()
         self.h = h
+        self.use_weight_norm = use_weight_norm
+        weight_norm = _weight_norm if use_weight_norm else _no_norm
         self.convs = nn.ModuleList([
             weight_norm(Conv1d(channels, channels, kernel_size, 1, dilation=dilation[0],
                                padding=get_padding(kernel_size, dilation[0]))),
@@ -60,22 +78,33 @@ class ResBlock2(torch.nn.Module):
         ])
         self.convs.apply(init_weights)
 
-    def forward(self, x):
+    def forward(self, x, inplace=False):
         for c in self.convs:
             xt = F.leaky_relu(x, LRELU_SLOPE)
             xt = c(xt)
-            x = xt + x
+            x = xt.add_(x) if inplace else xt + x
         return x
 
+    def layers(self):
+        """The convolutions of each residual unit, in application order."""
+        return [(c,) for c in self.convs]
+
     def remove_weight_norm(self):
+        if not self.use_weight_norm:
+            return
+        self.use_weight_norm = False
         for l in self.convs:
             remove_weight_norm(l)
 
 
 class Generator(torch.nn.Module):
-    def __init__(self, h):
+    """HiFi-GAN generator. With `use_weight_norm=False` the convolutions are built without weight norm,
+    matching the parameter layout left by remove_weight_norm(), e.g. to load an exported generator."""
+    def __init__(self, h, use_weight_norm=True):
         super(Generator, self).__init__()
         self.h = h
+        self.use_weight_norm = use_weight_norm
+        weight_norm = _weight_norm if use_weight_norm else _no_norm
         self.num_kernels = len(h.resblock_kernel_sizes)
         self.num_upsamples = len(h.upsample_rates)
         self.conv_pre = weight_norm(Conv1d(h.num_mels, h.upsample_initial_channel, 7, 1, padding=3))
@@ -91,13 +120,16 @@ class Generator(torch.nn.Module):
         for i in range(len(self.ups)):
             ch = h.upsample_initial_channel//(2**(i+1))
             for j, (k, d) in enumerate(zip(h.resblock_kernel_sizes, h.resblock_dilation_sizes)):
-                self.resblocks.append(resblock(h, ch, k, d))
+                self.resblocks.append(resblock(h, ch, k, d, use_weight_norm))
 
         self.conv_post = weight_norm(Conv1d(ch, 1, 7, 1, padding=3))
         self.ups.apply(init_weights)
         self.conv_post.apply(init_weights)
+        self.fused = False
 
     def forward(self, x):
+        if self.fused:
+            return self._forward_fused(x)
         x = self.conv_pre(x)
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, LRELU_SLOPE)
@@ -115,7 +147,44 @@ class Generator(torch.nn.Module):
 
         return x
 
+    def _forward_fused(self, x):
+        inplace = not torch.is_grad_enabled()
+        x = self.conv_pre(x)
+        for i in range(self.num_upsamples):
+            x = F.leaky_relu(x, LRELU_SLOPE, inplace)
+            x = self.ups[i](x)
+            xs = None
+            for j in range(self.num_kernels):
+                if xs is None:
+                    xs = self.resblocks[i*self.num_kernels+j](x, inplace)
+                else:
+                    xs += self.resblocks[i*self.num_kernels+j](x, inplace)
+            # The 1/num_kernels scale is folded into the next layer's weights by fuse().
+            x = xs
+        x = F.leaky_relu(x, 0.01, inplace)
+        x = self.conv_post(x)
+        return torch.tanh_(x) if inplace else torch.tanh(x)
+
+    def fuse(self):
+        """Switch to the inference-only forward path. Weight norm is removed first.
+
+        Leaky ReLU is positively homogeneous, so the 1/num_kernels average after every stage is folded
+        into the weights of the following transposed convolution (or conv_post), and activations run in
+        place when autograd is off. Outputs equal the reference forward up to float rounding. The folded
+        weights are not a training checkpoint, so save the state dict before fusing.
+        """
+        if self.fused:
+            return
+        self.remove_weight_norm()
+        with torch.no_grad():
+            for l in list(self.ups)[1:] + [self.conv_post]:
+                l.weight.div_(self.num_kernels)
+        self.fused = True
+
     def remove_weight_norm(self):
+        if not self.use_weight_norm:
+            return
+        self.use_weight_norm = False
         print('Removing weight norm...')
         for l in self.ups:
             remove_weight_norm(l)
@@ -160,10 +229,89 @@ class DiscriminatorP(torch.nn.Module):
 
         return x, fmap
 
+    def cost(self, t):
+        """Multiply-accumulates per batch item of forward() on t samples, for balancing parallel work."""
+        h = -(-t // self.period)
+        macs = 0
+        for l in list(self.convs) + [self.conv_post]:
+            h = (h + 2 * l.padding[0] - l.kernel_size[0]) // l.stride[0] + 1
+            macs += h * self.period * l.in_channels * l.out_channels * l.kernel_size[0]
+        return macs
+
+
+def split_real_generated(y_ds, fmaps, batch_size):
+    """Split the outputs of discriminate() on cat([y, y_hat]) into (y_d_rs, y_d_gs, fmap_rs, fmap_gs)."""
+    y_d_rs = [y_d[:batch_size] for y_d in y_ds]
+    y_d_gs = [y_d[batch_size:] for y_d in y_ds]
+    fmap_rs = [[f[:batch_size] for f in fmap] for fmap in fmaps]
+    fmap_gs = [[f[batch_size:] for f in fmap] for fmap in fmaps]
+    return y_d_rs, y_d_gs, fmap_rs, fmap_gs
+
+
+def schedule_by_cost(costs, num_groups):
+    """Partition indices into at most num_groups groups of similar total cost (longest processing time first)."""
+    groups = [[] for _ in range(min(num_groups, len(costs)))]
+    loads = [0] * len(groups)
+    for i in sorted(range(len(costs)), key=lambda i: -costs[i]):
+        g = loads.index(min(loads))
+        groups[g].append(i)
+        loads[g] += costs[i]
+    return [g for g in groups if len(g) > 0]
+
+
+class ParallelDiscriminatorRunner(object):
+    """Run sub-discriminators concurrently on a thread pool, grouped by estimated cost.
+
+    torch.jit.fork runs synchronously outside TorchScript, so plain threads are used; the convolutions
+    release the GIL. Grad mode and autocast are thread-local and are carried over to the workers.
+    """
+    def __init__(self, num_threads):
+        self.num_threads = num_threads
+        self._executor = None
+        self._plans = {}
+
+    @staticmethod
+    def _run_group(state, discriminators, inputs, group):
+        grad_enabled, gpu_autocast, gpu_dtype, cpu_autocast, cpu_dtype = state
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(torch.set_grad_enabled(grad_enabled))
+            if gpu_autocast:
+                stack.enter_context(torch.autocast('cuda', dtype=gpu_dtype))
+            if cpu_autocast:
+                stack.enter_context(torch.autocast('cpu', dtype=cpu_dtype))
+            return [discriminators[i](inputs[i]) for i in group]
+
+    def __call__(self, discriminators, inputs):
+        key = tuple(x.size(-1) for x in inputs)
+        if key not in self._plans:
+            costs = [d.cost(x.size(-1)) for d, x in zip(discriminators, inputs)]
+            self._plans[key] = schedule_by_cost(costs, self.num_threads)
+        plan = self._plans[key]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=max(self.num_threads - 1, 1))
+
+        # The calling thread runs the first group itself.
+        state = (torch.is_grad_enabled(), torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype(),
+                 torch.is_autocast_cpu_enabled(), torch.get_autocast_cpu_dtype())
+        futures = [self._executor.submit(self._run_group, state, discriminators, inputs, group)
+                   for group in plan[1:]]
+        group_outputs = [self._run_group(state, discriminators, inputs, plan[0])] + [f.result() for f in futures]
+        results = [None] * len(discriminators)
+        for group, outputs in zip(plan, group_outputs):
+            for i, output in zip(group, outputs):
+                results[i] = output
+        return results
+
 
 class MultiPeriodDiscriminator(torch.nn.Module):
-    def __init__(self):
+    """With fused=True, real and generated audio go through each sub-discriminator as one batch.
+
+    With num_threads > 1 the periods run concurrently, see ParallelDiscriminatorRunner.
+    """
+    def __init__(self, fused=False, num_threads=1):
         super(MultiPeriodDiscriminator, self).__init__()
+        self.fused = fused
+        self.runner = ParallelDiscriminatorRunner(num_threads) if num_threads > 1 else None
         self.discriminators = nn.ModuleList([
             DiscriminatorP(2),
             DiscriminatorP(3),
@@ -172,7 +320,29 @@ class MultiPeriodDiscriminator(torch.nn.Module):
             DiscriminatorP(11),
         ])
 
+    def discriminate(self, x):
+        """Run every sub-discriminator on a single input and return (y_ds, fmaps)."""
+        if self.runner is not None:
+            outputs = self.runner(self.discriminators, [x] * len(self.discriminators))
+            return [y_d for y_d, _ in outputs], [fmap for _, fmap in outputs]
+
+        y_ds = []
+        fmaps = []
+        for d in self.discriminators:
+            y_d, fmap = d(x)
+            y_ds.append(y_d)
+            fmaps.append(fmap)
+        return y_ds, fmaps
+
     def forward(self, y, y_hat):
+        if self.fused and y.shape == y_hat.shape:
+            y_ds, fmaps = self.discriminate(torch.cat([y, y_hat], dim=0))
+            return split_real_generated(y_ds, fmaps, y.size(0))
+        if self.runner is not None:
+            y_d_rs, fmap_rs = self.discriminate(y)
+            y_d_gs, fmap_gs = self.discriminate(y_hat)
+            return y_d_rs, y_d_gs, fmap_rs, fmap_gs
+
         y_d_rs = []
         y_d_gs = []
         fmap_rs = []
@@ -215,10 +385,25 @@ class DiscriminatorS(torch.nn.Module):
 
         return x, fmap
 
+    def cost(self, t):
+        """Multiply-accumulates per batch item of forward() on t samples, for balancing parallel work."""
+        macs = 0
+        for l in list(self.convs) + [self.conv_post]:
+            t = (t + 2 * l.padding[0] - l.dilation[0] * (l.kernel_size[0] - 1) - 1) // l.stride[0] + 1
+            macs += t * l.in_channels * l.out_channels // l.groups * l.kernel_size[0]
+        return macs
+
 
 class MultiScaleDiscriminator(torch.nn.Module):
-    def __init__(self):
+    """With fused=True, real and generated audio go through each sub-discriminator as one batch.
+
+    The spectral-norm scale then runs one power iteration per call instead of one per input.
+    With num_threads > 1 the scales run concurrently, see ParallelDiscriminatorRunner.
+    """
+    def __init__(self, fused=False, num_threads=1):
         super(MultiScaleDiscriminator, self).__init__()
+        self.fused = fused
+        self.runner = ParallelDiscriminatorRunner(num_threads) if num_threads > 1 else None
         self.discriminators = nn.ModuleList([
             DiscriminatorS(use_spectral_norm=True),
             DiscriminatorS(),
@@ -229,7 +414,34 @@ class MultiScaleDiscriminator(torch.nn.Module):
             AvgPool1d(4, 2, padding=2)
         ])
 
+    def discriminate(self, x):
+        """Run every sub-discriminator on a single input and return (y_ds, fmaps)."""
+        if self.runner is not None:
+            inputs = [x]
+            for pool in self.meanpools:
+                inputs.append(pool(inputs[-1]))
+            outputs = self.runner(self.discriminators, inputs)
+            return [y_d for y_d, _ in outputs], [fmap for _, fmap in outputs]
+
+        y_ds = []
+        fmaps = []
+        for i, d in enumerate(self.discriminators):
+            if i != 0:
+                x = self.meanpools[i-1](x)
+            y_d, fmap = d(x)
+            y_ds.append(y_d)
+            fmaps.append(fmap)
+        return y_ds, fmaps
+
     def forward(self, y, y_hat):
+        if self.fused and y.shape == y_hat.shape:
+            y_ds, fmaps = self.discriminate(torch.cat([y, y_hat], dim=0))
+            return split_real_generated(y_ds, fmaps, y.size(0))
+        if self.runner is not None:
+            y_d_rs, fmap_rs = self.discriminate(y)
+            y_d_gs, fmap_gs = self.discriminate(y_hat)
+            return y_d_rs, y_d_gs, fmap_rs, fmap_gs
+
         y_d_rs = []
         y_d_gs = []
         fmap_rs = []
@@ -252,7 +464,7 @@ def feature_loss(fmap_r, fmap_g):
     loss = 0
     for dr, dg in zip(fmap_r, fmap_g):
         for rl, gl in zip(dr, dg):
-            loss += torch.mean(torch.abs(rl - gl))
+            loss += torch.mean(torch.abs(rl.float() - gl.float()))
 
     return loss*2
 
@@ -262,8 +474,8 @@ def discriminator_loss(disc_real_outputs, disc_generated_outputs):
     r_losses = []
     g_losses = []
     for dr, dg in zip(disc_real_outputs, disc_generated_outputs):
-        r_loss = torch.mean((1-dr)**2)
-        g_loss = torch.mean(dg**2)
+        r_loss = torch.mean((1-dr.float())**2)
+        g_loss = torch.mean(dg.float()**2)
         loss += (r_loss + g_loss)
         r_losses.append(r_loss.item())
         g_losses.append(g_loss.item())
@@ -275,7 +487,7 @@ def generator_loss(disc_outputs):
     loss = 0
     gen_losses = []
     for dg in disc_outputs:
-        l = torch.mean((1-dg)**2)
+        l = torch.mean((1-dg.float())**2)
         gen_losses.append(l)
         loss += l
 
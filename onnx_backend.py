@@ -0,0 +1,72 @@
+import json
+import torch
+from env import AttrDict
+
+ONNX_CONFIG_KEY = 'hifigan_config'
+
+onnx_sessions = {}
+
+
+def is_onnx_generator(filepath):
+    return filepath.endswith('.onnx')
+
+
+def export_onnx(generator, h, output_file, opset_version=17):
+    """Trace a weight-norm-free generator to ONNX with dynamic batch and time axes, embedding the config."""
+    import onnx
+
+    mel = torch.randn(1, h.num_mels, 64)
+    with torch.no_grad():
+        torch.onnx.export(generator, mel, output_file, input_names=['mel'], output_names=['audio'],
+                          dynamic_axes={'mel': {0: 'batch', 2: 'frames'}, 'audio': {0: 'batch', 2: 'samples'}},
+                          opset_version=opset_version)
+    model = onnx.load(output_file)
+    entry = model.metadata_props.add()
+    entry.key = ONNX_CONFIG_KEY
+    entry.value = json.dumps(dict(h))
+    onnx.checker.check_model(model)
+    onnx.save(model, output_file)
+
+
+def onnx_session(filepath, num_threads=0):
+    """Return the process-wide onnxruntime CPU session for `filepath`, creating it on first use."""
+    import onnxruntime
+
+    key = (filepath, num_threads)
+    if key not in onnx_sessions:
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads
+        onnx_sessions[key] = onnxruntime.InferenceSession(filepath, options, providers=['CPUExecutionProvider'])
+    return onnx_sessions[key]
+
+
+def onnx_generator_config(filepath, num_threads=0):
+    session = onnx_session(filepath, num_threads)
+    return AttrDict(json.loads(session.get_modelmeta().custom_metadata_map[ONNX_CONFIG_KEY]))
+
+
+class OnnxGenerator(object):
+    """Run an exported ONNX generator through onnxruntime, called like Generator on CPU tensors."""
+    def __init__(self, filepath, num_threads=0):
+        self.session = onnx_session(filepath, num_threads)
+        self.h = onnx_generator_config(filepath, num_threads)
+
+    def __call__(self, x):
+        audio = self.session.run(None, {'mel': x.detach().cpu().numpy()})[0]
+        return torch.from_numpy(audio)
+
+
+def check_onnx_parity(generator, filepath, num_mels, lengths=(32, 200), atol=1e-4):
+    """Compare torch and onnxruntime outputs on random mels of several lengths and return the largest
+    absolute difference. Raises ValueError when it exceeds `atol`."""
+    onnx_generator = OnnxGenerator(filepath)
+    max_diff = 0.
+    with torch.no_grad():
+        for length in lengths:
+            mel = torch.randn(2, num_mels, length)
+            diff = (generator(mel) - onnx_generator(mel)).abs().max().item()
+            max_diff = max(max_diff, diff)
+    if max_diff > atol:
+        raise ValueError("ONNX output differs from torch by {:.2e} (> {:.0e})".format(max_diff, atol))
+    return max_diff
@@ -0,0 +1,197 @@
+import argparse
+import json
+import os
+import numpy as np
+from scipy.signal import resample
+from env import AttrDict
+from meldataset import MAX_WAV_VALUE, load_wav
+from manifest import get_manifest, manifest_filelists
+
+PACKED_AUDIO_VERSION = 1
+PACKED_MEL_VERSION = 1
+
+
+def load_pcm16(filename, sampling_rate):
+    """Load a wav file as int16 PCM at `sampling_rate`."""
+    audio, sr = load_wav(filename)
+    if sr != sampling_rate or audio.dtype != np.int16:
+        audio = audio / MAX_WAV_VALUE
+        if sr != sampling_rate:
+            number_of_samples = round(len(audio) * float(sampling_rate) / sr)
+            audio = resample(audio, number_of_samples)
+        audio = np.clip(audio * MAX_WAV_VALUE, -MAX_WAV_VALUE, MAX_WAV_VALUE - 1).astype(np.int16)
+    return audio
+
+
+def pack_audio(filelist, prefix, sampling_rate):
+    """Pack wav files into `<prefix>.bin` (one contiguous int16 array) and `<prefix>.json` (offset/length index).
+
+    Audio is resampled to `sampling_rate` while packing, so readers never have to resample.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+    files = {}
+    offset = 0
+    with open(prefix + '.bin', 'wb') as f:
+        for filename in filelist:
+            audio = load_pcm16(filename, sampling_rate)
+            f.write(audio.tobytes())
+            files[filename] = [offset, len(audio)]
+            offset += len(audio)
+
+    index = {'version': PACKED_AUDIO_VERSION, 'sampling_rate': sampling_rate, 'num_samples': offset, 'files': files}
+    with open(prefix + '.json', 'w') as f:
+        json.dump(index, f)
+    return index
+
+
+class PackedAudioStore(object):
+    """Read-only view of a store written by pack_audio.
+
+    The sample array is memory-mapped lazily, so each DataLoader worker opens its own mapping and
+    only the pages inside a requested window are ever read from disk.
+    """
+    def __init__(self, prefix):
+        with open(prefix + '.json') as f:
+            index = json.load(f)
+        if index.get('version') != PACKED_AUDIO_VERSION:
+            raise ValueError("{} has packed audio version {}, expected {}".format(
+                prefix, index.get('version'), PACKED_AUDIO_VERSION))
+        self.prefix = prefix
+        self.sampling_rate = index['sampling_rate']
+        self.files = index['files']
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.memmap(self.prefix + '.bin', dtype=np.int16, mode='r')
+        return self._data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def __contains__(self, filename):
+        return filename in self.files
+
+    def __len__(self):
+        return len(self.files)
+
+    def length(self, filename):
+        return self.files[filename][1]
+
+    def iter_files(self):
+        """Yield (filename, int16 audio) in on-disk order, i.e. as one sequential read of the store."""
+        for filename, (offset, length) in sorted(self.files.items(), key=lambda item: item[1][0]):
+            yield filename, np.array(self.data[offset:offset + length])
+
+    def read(self, filename, start=0, end=None):
+        offset, length = self.files[filename]
+        end = length if end is None else min(end, length)
+        return np.array(self.data[offset + start:offset + end])
+
+
+def pack_mels(mels_dir, prefix):
+    """Pack the .npy mels of mels_dir into `<prefix>.bin` and `<prefix>.json`.
+
+    Mels are stored frame-major as float32 (total_frames, num_mels), so any crop of consecutive frames
+    is one contiguous read. The index maps each mel's file stem to its [frame offset, frames].
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+    files = {}
+    offset = 0
+    num_mels = None
+    with open(prefix + '.bin', 'wb') as f:
+        for name in sorted(os.listdir(mels_dir)):
+            if not name.endswith('.npy'):
+                continue
+            mel = np.load(os.path.join(mels_dir, name)).astype(np.float32)
+            mel = mel.reshape(mel.shape[-2], mel.shape[-1])
+            if num_mels is None:
+                num_mels = mel.shape[0]
+            elif mel.shape[0] != num_mels:
+                raise ValueError("{} has {} mel channels, expected {}".format(name, mel.shape[0], num_mels))
+            f.write(np.ascontiguousarray(mel.T).tobytes())
+            files[os.path.splitext(name)[0]] = [offset, mel.shape[1]]
+            offset += mel.shape[1]
+
+    index = {'version': PACKED_MEL_VERSION, 'num_mels': num_mels, 'num_frames': offset, 'files': files}
+    with open(prefix + '.json', 'w') as f:
+        json.dump(index, f)
+    return index
+
+
+class PackedMelStore(object):
+    """Read-only view of a store written by pack_mels; only the requested frames are read from disk."""
+    def __init__(self, prefix):
+        with open(prefix + '.json') as f:
+            index = json.load(f)
+        if index.get('version') != PACKED_MEL_VERSION:
+            raise ValueError("{} has packed mel version {}, expected {}".format(
+                prefix, index.get('version'), PACKED_MEL_VERSION))
+        self.prefix = prefix
+        self.num_mels = index['num_mels']
+        self.files = index['files']
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.memmap(self.prefix + '.bin', dtype=np.float32, mode='r').reshape(-1, self.num_mels)
+        return self._data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def __len__(self):
+        return len(self.files)
+
+    def length(self, name):
+        return self.files[name][1]
+
+    def read(self, name, start=0, end=None):
+        """Return frames [start, end) of mel `name` as a (num_mels, frames) array."""
+        offset, length = self.files[name]
+        end = length if end is None else min(end, length)
+        return np.array(self.data[offset + start:offset + end].T)
+
+
+def main():
+    print('Packing audio files..')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', required=True)
+    parser.add_argument('--output_prefix', required=True)
+    parser.add_argument('--input_mels_dir', default=None)
+    parser.add_argument('--checkpoint_path', default='cp_hifigan3')
+    parser.add_argument('--manifest', default=None)
+    a = parser.parse_args()
+
+    if a.input_mels_dir:
+        index = pack_mels(a.input_mels_dir, a.output_prefix)
+        print('Packed {} mels, {} frames into {}.bin'.format(len(index['files']), index['num_frames'],
+                                                            a.output_prefix))
+        return
+
+    with open(a.config) as f:
+        data = f.read()
+
+    json_config = json.loads(data)
+    h = AttrDict(json_config)
+
+    # Pack the paths train.py looks up: those of the run's manifest, built here if it does not exist yet.
+    manifest_file = a.manifest or os.path.join(a.checkpoint_path, 'manifest.jsonl')
+    training_files, validation_files = manifest_filelists(get_manifest(manifest_file, h))
+    index = pack_audio(sorted(training_files + validation_files), a.output_prefix, h.sampling_rate)
+    print('Packed {} files, {} samples into {}.bin'.format(len(index['files']), index['num_samples'],
+                                                           a.output_prefix))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import copy
+import json
+import os
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao.nn.quantized import dynamic as nnqd
+from torch.ao.quantization import default_dynamic_qconfig, get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from env import AttrDict
+from export import load_inference_generator, save_scripted_generator
+from meldataset import mel_frontend
+
+
+def load_calibration_mels(mels_dir, limit=None):
+    """(1, num_mels, frames) tensors from the .npy mels in mels_dir, in name order."""
+    mels = []
+    for name in sorted(n for n in os.listdir(mels_dir) if n.endswith('.npy'))[:limit]:
+        x = torch.FloatTensor(np.load(os.path.join(mels_dir, name)))
+        mels.append(x.reshape(1, x.size(-2), x.size(-1)))
+    return mels
+
+
+def quantize_generator_dynamic(generator):
+    """INT8 weights with activations quantized on the fly, for every Conv1d and ConvTranspose1d."""
+    qconfig_spec = {nn.Conv1d: default_dynamic_qconfig, nn.ConvTranspose1d: default_dynamic_qconfig}
+    mapping = {nn.Conv1d: nnqd.Conv1d, nn.ConvTranspose1d: nnqd.ConvTranspose1d}
+    return quantize_dynamic(generator, qconfig_spec, mapping=mapping)
+
+
+def quantize_generator_static(generator, calibration_mels, backend='x86'):
+    """INT8 weights and activations, with activation ranges observed on `calibration_mels` (FX graph mode)."""
+    torch.backends.quantized.engine = backend
+    prepared = prepare_fx(generator, get_default_qconfig_mapping(backend), (calibration_mels[0],))
+    with torch.no_grad():
+        for mel in calibration_mels:
+            prepared(mel)
+    return convert_fx(prepared)
+
+
+def mel_l1_drift(reference, quantized, mels, mel_spec):
+    """Mean L1 distance between the mels of the reference and the quantized generator's outputs."""
+    errors = []
+    with torch.no_grad():
+        for mel in mels:
+            y_ref = mel_spec(reference(mel).squeeze(1))
+            y_q = mel_spec(quantized(mel).squeeze(1))
+            errors.append(F.l1_loss(y_q, y_ref).item())
+    return sum(errors) / len(errors)
+
+
+def time_generator(generator, mels):
+    with torch.no_grad():
+        start = time.time()
+        for mel in mels:
+            generator(mel)
+        return time.time() - start
+
+
+def main():
+    print('Quantizing generator..')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint_file', required=True)
+    parser.add_argument('--output_file', required=True)
+    parser.add_argument('--calibration_mels_dir', required=True)
+    parser.add_argument('--mode', default='static', choices=['dynamic', 'static'])
+    parser.add_argument('--num_calibration', default=32, type=int)
+    parser.add_argument('--config', default=None)
+    a = parser.parse_args()
+
+    config_file = a.config or os.path.join(os.path.split(a.checkpoint_file)[0], 'config.json')
+    with open(config_file) as f:
+        data = f.read()
+
+    json_config = json.loads(data)
+    h = AttrDict(json_config)
+
+    device = torch.device('cpu')
+    mels = load_calibration_mels(a.calibration_mels_dir, a.num_calibration)
+    reference = load_inference_generator(a.checkpoint_file, h, device)
+    generator = copy.deepcopy(reference)
+
+    if a.mode == 'dynamic':
+        quantized = quantize_generator_dynamic(generator)
+    else:
+        quantized = quantize_generator_static(generator, mels)
+
+    mel_spec = mel_frontend(h.n_fft, h.num_mels, h.sampling_rate, h.hop_size, h.win_size, h.fmin, h.fmax_for_loss)
+    print('Mel-Spec. L1 drift against fp32 : {:4.4f}'.format(mel_l1_drift(reference, quantized, mels, mel_spec)))
+    fp32_time = time_generator(reference, mels)
+    int8_time = time_generator(quantized, mels)
+    print('fp32 : {:4.3f} s, int8 : {:4.3f} s, speed-up : {:4.2f}x'.format(fp32_time, int8_time,
+                                                                         fp32_time / int8_time))
+
+    with torch.no_grad():
+        traced = torch.jit.trace(quantized, mels[0])
+    save_scripted_generator(traced, h, a.output_file, 'int8-' + a.mode)
+    print('Wrote {}'.format(a.output_file))
+
+
+if __name__ == '__main__':
+    main()
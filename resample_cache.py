@@ -0,0 +1,60 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.io.wavfile import read
+from meldataset import MAX_WAV_VALUE, load_wav, resample_audio
+
+
+class ResampleCache(object):
+    """Content-addressed on-disk cache of audio resampled to `target_sr`.
+
+    Entries are float32 .npy files keyed by (path, mtime, source sr, target sr), so an edited or
+    replaced wav never hits a stale entry. Files already at `target_sr` are read straight from disk.
+    Misses are resampled with `mode` ('poly' by default) and written back atomically, which makes the
+    cache safe to fill from several DataLoader workers or DDP ranks at once.
+    """
+    def __init__(self, cache_dir, target_sr, mode='poly'):
+        self.cache_dir = cache_dir
+        self.target_sr = target_sr
+        self.mode = mode
+
+    def key(self, filename, orig_sr):
+        mtime = os.stat(filename).st_mtime_ns
+        key = '{}|{}|{}|{}'.format(os.path.abspath(filename), mtime, orig_sr, self.target_sr)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npy')
+
+    def load(self, filename):
+        # mmap=True only parses the header, the samples are decoded below if needed.
+        orig_sr, _ = read(filename, mmap=True)
+        if orig_sr == self.target_sr:
+            audio, _ = load_wav(filename)
+            return audio / MAX_WAV_VALUE
+
+        path = self.entry_path(self.key(filename, orig_sr))
+        if os.path.isfile(path):
+            return np.load(path)
+
+        audio, _ = load_wav(filename)
+        audio = resample_audio(audio / MAX_WAV_VALUE, orig_sr, self.target_sr, self.mode).astype(np.float32)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, audio)
+        os.replace(tmp_path, path)
+        return audio
+
+    def _fill(self, filename):
+        orig_sr, _ = read(filename, mmap=True)
+        if orig_sr == self.target_sr or os.path.isfile(self.entry_path(self.key(filename, orig_sr))):
+            return False
+        self.load(filename)
+        return True
+
+    def build(self, filelist, num_workers=None):
+        """Resample every file of `filelist` that is not cached yet. Returns the number of new entries."""
+        with ProcessPoolExecutor(max_workers=num_workers or None) as executor:
+            return sum(executor.map(self._fill, filelist, chunksize=16))
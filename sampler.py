@@ -0,0 +1,75 @@
+import random
+import torch
+import torch.utils.data
+
+
+class LengthBucketBatchSampler(torch.utils.data.Sampler):
+    """Group utterances of similar length into batches whose padded size stays within a frame budget.
+
+    `lengths` are per-index lengths in mel frames. A batch holds as many length-sorted utterances as fit
+    in `max_frames` once padded to its longest member, so short clips batch widely and long ones narrowly.
+    """
+    def __init__(self, lengths, max_frames, max_batch_size=None, shuffle=False, seed=1234):
+        self.lengths = lengths
+        self.max_frames = max_frames
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.batches = self._make_batches()
+
+    def _make_batches(self):
+        batches = []
+        batch = []
+        longest = 0
+        for i in sorted(range(len(self.lengths)), key=lambda i: self.lengths[i]):
+            longest_with_i = max(longest, self.lengths[i])
+            full = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+            if len(batch) > 0 and (longest_with_i * (len(batch) + 1) > self.max_frames or full):
+                batches.append(batch)
+                batch = []
+                longest_with_i = self.lengths[i]
+            batch.append(i)
+            longest = longest_with_i
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        batches = list(self.batches)
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class PadCollate(object):
+    """Zero-pad (mel, audio, filename, mel_loss) items to the longest in the batch and append mel lengths.
+
+    Items whose mels are left to the caller (empty tensors) get their length from the audio instead.
+    """
+    def __init__(self, hop_size):
+        self.hop_size = hop_size
+
+    @staticmethod
+    def _pad_stack(tensors):
+        longest = max(t.size(-1) for t in tensors)
+        return torch.stack([torch.nn.functional.pad(t, (0, longest - t.size(-1)), 'constant') for t in tensors])
+
+    def __call__(self, batch):
+        mels, audios, filenames, mel_losses = zip(*batch)
+        lengths = torch.LongTensor([m.size(-1) if m.numel() > 0 else a.size(-1) // self.hop_size
+                                    for m, a in zip(mels, audios)])
+        return (self._pad_stack(mels), self._pad_stack(audios), list(filenames), self._pad_stack(mel_losses),
+                lengths)
+
+
+def length_mask(lengths, max_len):
+    """(B, 1, max_len) mask that is 1 on the valid frames of each batch item."""
+    mask = torch.arange(max_len, device=lengths.device).unsqueeze(0) < lengths.unsqueeze(1)
+    return mask.unsqueeze(1)
@@ -0,0 +1,174 @@
+import argparse
+import io
+import itertools
+import json
+import os
+import random
+import tarfile
+import numpy as np
+import torch
+import torch.utils.data
+from env import AttrDict
+from meldataset import MAX_WAV_VALUE
+from manifest import get_manifest, manifest_filelists
+from packed_store import PackedAudioStore, load_pcm16
+
+
+def write_shards(filelist, output_pattern, sampling_rate, files_per_shard=1000):
+    """Write filelist as tar shards of int16 .npy audio at `sampling_rate`.
+
+    Every utterance is stored as a `<key>.txt` member holding its original path followed by a
+    `<key>.npy` member holding its samples. `output_pattern` is formatted with the shard number.
+    """
+    shards = []
+    for shard_start in range(0, len(filelist), files_per_shard):
+        shard_path = output_pattern.format(len(shards))
+        os.makedirs(os.path.dirname(os.path.abspath(shard_path)), exist_ok=True)
+        shard_files = filelist[shard_start:shard_start + files_per_shard]
+        with tarfile.open(shard_path, 'w') as tar:
+            for i, filename in enumerate(shard_files):
+                key = '{:08d}'.format(shard_start + i)
+                name = filename.encode('utf-8')
+                info = tarfile.TarInfo(key + '.txt')
+                info.size = len(name)
+                tar.addfile(info, io.BytesIO(name))
+
+                buf = io.BytesIO()
+                np.save(buf, load_pcm16(filename, sampling_rate))
+                info = tarfile.TarInfo(key + '.npy')
+                info.size = buf.tell()
+                buf.seek(0)
+                tar.addfile(info, buf)
+        with open(shard_path + '.json', 'w') as f:
+            json.dump({'num_items': len(shard_files)}, f)
+        shards.append(shard_path)
+    return shards
+
+
+def shard_length(shard):
+    """Number of utterances in a tar shard or packed store prefix, without reading any audio."""
+    if not shard.endswith('.tar'):
+        return len(PackedAudioStore(shard))
+    if os.path.isfile(shard + '.json'):
+        with open(shard + '.json') as f:
+            return json.load(f)['num_items']
+    with tarfile.open(shard) as tar:
+        return sum(1 for name in tar.getnames() if name.endswith('.npy'))
+
+
+def iter_shard(shard):
+    """Yield (filename, int16 audio) from a tar shard or a packed store prefix, reading it front to back."""
+    if not shard.endswith('.tar'):
+        for item in PackedAudioStore(shard).iter_files():
+            yield item
+        return
+
+    filename = None
+    with tarfile.open(shard, 'r|') as tar:
+        for member in tar:
+            if member.name.endswith('.txt'):
+                filename = tar.extractfile(member).read().decode('utf-8')
+            elif member.name.endswith('.npy'):
+                yield filename, np.load(io.BytesIO(tar.extractfile(member).read()))
+
+
+class ShardedMelDataset(torch.utils.data.IterableDataset):
+    """Stream utterances from shards in sequence, with the same output as MelDataset.
+
+    Shards are split across DDP ranks first and DataLoader workers second, so every process reads
+    whole shards sequentially. Like DistributedSampler, every rank yields the same number of items
+    per epoch: each worker stops after the item count of the smallest (rank, worker) share, so all
+    ranks run the same number of batches. `mel_dataset` is a MelDataset that supplies cropping and
+    mel settings; its own file list is not used.
+    """
+    def __init__(self, shards, mel_dataset, shuffle=True, shuffle_buffer=1000, rank=0, world_size=1, seed=1234):
+        if len(shards) < world_size:
+            raise ValueError("{} shards cannot be split across {} ranks".format(len(shards), world_size))
+        self.shards = list(shards)
+        self.lengths = [shard_length(shard) for shard in self.shards]
+        self.mel_dataset = mel_dataset
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _process_shards(self):
+        """This process's shards and the number of items every (rank, worker) yields this epoch."""
+        order = list(range(len(self.shards)))
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(order)
+        worker_info = torch.utils.data.get_worker_info()
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        worker_id = worker_info.id if worker_info is not None else 0
+        # Every process computes every share from the same seed, so they all agree on the count.
+        shares = [order[rank::self.world_size][worker::num_workers]
+                  for rank in range(self.world_size) for worker in range(num_workers)]
+        num_items = min(sum(self.lengths[i] for i in share) for share in shares)
+        if num_items == 0:
+            raise ValueError("{} shards leave some of the {} ranks x {} workers without data".format(
+                len(self.shards), self.world_size, num_workers))
+        return [self.shards[i] for i in shares[self.rank * num_workers + worker_id]], num_items
+
+    def _stream(self):
+        shards, num_items = self._process_shards()
+        items = (item for shard in shards for item in iter_shard(shard))
+        for item in itertools.islice(items, num_items):
+            yield item
+
+    def _shuffled(self, rng):
+        buffer = []
+        for item in self._stream():
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(item)
+                continue
+            j = rng.randrange(len(buffer))
+            yield buffer[j]
+            buffer[j] = item
+        rng.shuffle(buffer)
+        for item in buffer:
+            yield item
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        rng = random.Random(hash((self.seed, self.epoch, self.rank, worker_id)))
+        items = self._shuffled(rng) if self.shuffle else self._stream()
+        for filename, audio in items:
+            yield self.mel_dataset.make_item(filename, len(audio),
+                                             lambda start, end, audio=audio: audio[start:end] / MAX_WAV_VALUE)
+
+
+def main():
+    print('Writing dataset shards..')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', required=True)
+    parser.add_argument('--output_dir', required=True)
+    parser.add_argument('--checkpoint_path', default='cp_hifigan3')
+    parser.add_argument('--manifest', default=None)
+    parser.add_argument('--files_per_shard', default=1000, type=int)
+    a = parser.parse_args()
+
+    with open(a.config) as f:
+        data = f.read()
+
+    json_config = json.loads(data)
+    h = AttrDict(json_config)
+
+    # Shard the run's manifest split, so no validation utterance ends up in the training shards.
+    manifest_file = a.manifest or os.path.join(a.checkpoint_path, 'manifest.jsonl')
+    training_files, validation_files = manifest_filelists(get_manifest(manifest_file, h))
+
+    for split, filelist in (('train', training_files), ('validation', validation_files)):
+        shards = write_shards(filelist, os.path.join(a.output_dir, split + '-{:06d}.tar'), h.sampling_rate,
+                              a.files_per_shard)
+        print('Wrote {} {} files into {} shards'.format(len(filelist), split, len(shards)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+import torch
+import torch.nn.functional as F
+from models import LRELU_SLOPE
+from synthesis import receptive_field
+
+
+class StreamingConv1d(object):
+    """Incremental stride-1 Conv1d with symmetric zero padding.
+
+    The last 2 * padding input samples are kept between calls, so every call computes only the outputs
+    whose whole window has arrived. The left padding is a zero prefix on the first call and the right
+    padding is appended when `final` is set.
+    """
+    def __init__(self, conv):
+        self.conv = conv
+        self.pad = conv.padding[0]
+        self.reset()
+
+    def reset(self):
+        self.buffer = None
+
+    def __call__(self, x, final=False):
+        if self.buffer is None:
+            self.buffer = x.new_zeros(x.size(0), x.size(1), self.pad)
+        x = torch.cat([self.buffer, x], -1)
+        if final:
+            x = F.pad(x, (0, self.pad))
+        if x.size(-1) <= 2 * self.pad:
+            self.buffer = x
+            return x.new_zeros(x.size(0), self.conv.out_channels, 0)
+        self.buffer = x[..., x.size(-1) - 2 * self.pad:]
+        return F.conv1d(x, self.conv.weight, self.conv.bias, 1, 0, self.conv.dilation)
+
+
+class StreamingConvTranspose1d(object):
+    """Incremental ConvTranspose1d by overlap-add.
+
+    Each call's unpadded output is added onto the tail carried from the previous call. Samples that no
+    later input can reach are released, after the first `padding` samples of the stream are dropped.
+    The carried tail is released on the `final` call.
+    """
+    def __init__(self, conv):
+        self.conv = conv
+        self.stride = conv.stride[0]
+        self.kernel_size = conv.kernel_size[0]
+        self.pad = conv.padding[0]
+        self.reset()
+
+    def reset(self):
+        self.carry = None
+        self.to_crop = self.pad
+
+    def __call__(self, x, final=False):
+        out = x.new_zeros(x.size(0), self.conv.out_channels, 0)
+        if x.size(-1) > 0:
+            z = F.conv_transpose1d(x, self.conv.weight, None, self.stride)
+            if self.carry is not None:
+                z[..., :self.carry.size(-1)] += self.carry
+            ready = x.size(-1) * self.stride
+            out, self.carry = z[..., :ready], z[..., ready:]
+        if final and self.carry is not None:
+            out = torch.cat([out, self.carry[..., :self.kernel_size - self.stride - self.pad]], -1)
+            self.carry = None
+        if self.to_crop > 0:
+            cropped = min(self.to_crop, out.size(-1))
+            out = out[..., cropped:]
+            self.to_crop -= cropped
+        if self.conv.bias is not None:
+            out = out + self.conv.bias[None, :, None]
+        return out
+
+
+class AlignedSum(object):
+    """Sum streams that arrive at different rates, releasing only the samples every stream has produced."""
+    def __init__(self, num_streams):
+        self.num_streams = num_streams
+        self.reset()
+
+    def reset(self):
+        self.pending = [None] * self.num_streams
+
+    def __call__(self, streams):
+        self.pending = [s if p is None else torch.cat([p, s], -1) for p, s in zip(self.pending, streams)]
+        n = min(p.size(-1) for p in self.pending)
+        out = self.pending[0][..., :n]
+        for p in self.pending[1:]:
+            out = out + p[..., :n]
+        self.pending = [p[..., n:] for p in self.pending]
+        return out
+
+
+class StreamingResBlock(object):
+    """Streaming counterpart of ResBlock1 and ResBlock2; residuals wait in an AlignedSum for their branch."""
+    def __init__(self, block):
+        self.layers = [tuple(StreamingConv1d(c) for c in convs) for convs in block.layers()]
+        self.residuals = [AlignedSum(2) for _ in self.layers]
+
+    def reset(self):
+        for convs, residual in zip(self.layers, self.residuals):
+            for c in convs:
+                c.reset()
+            residual.reset()
+
+    def __call__(self, x, final=False):
+        for convs, residual in zip(self.layers, self.residuals):
+            xt = x
+            for c in convs:
+                xt = F.leaky_relu(xt, LRELU_SLOPE)
+                xt = c(xt, final)
+            x = residual([xt, x])
+        return x
+
+
+class StreamingGenerator(object):
+    """Vocode mel frames as they arrive, with output equal to Generator.forward on the whole input.
+
+    Every convolution keeps its left context between calls (see StreamingConv1d and
+    StreamingConvTranspose1d), so `push` computes only new samples and returns the audio that later
+    frames can no longer change. Audio for a frame is released once at most `lookahead` further
+    frames (receptive_field(h)) have been pushed. `flush` ends the utterance, returns the rest of the
+    audio and resets the state. Weight norm is removed from `generator`, which should be in eval mode
+    and called under torch.no_grad().
+    """
+    def __init__(self, generator):
+        generator.remove_weight_norm()
+        self.generator = generator
+        self.num_kernels = generator.num_kernels
+        self.num_upsamples = generator.num_upsamples
+        self.lookahead = receptive_field(generator.h)
+        self.conv_pre = StreamingConv1d(generator.conv_pre)
+        self.ups = [StreamingConvTranspose1d(l) for l in generator.ups]
+        self.resblocks = [StreamingResBlock(b) for b in generator.resblocks]
+        self.mrf_sums = [AlignedSum(self.num_kernels) for _ in generator.ups]
+        self.conv_post = StreamingConv1d(generator.conv_post)
+
+    def reset(self):
+        for layer in [self.conv_pre, self.conv_post] + self.ups + self.resblocks + self.mrf_sums:
+            layer.reset()
+
+    def _step(self, x, final):
+        x = self.conv_pre(x, final)
+        for i in range(self.num_upsamples):
+            x = F.leaky_relu(x, LRELU_SLOPE)
+            x = self.ups[i](x, final)
+            xs = self.mrf_sums[i]([self.resblocks[i*self.num_kernels+j](x, final)
+                                   for j in range(self.num_kernels)])
+            # A fused generator has the average folded into the next layer's weights.
+            x = xs if self.generator.fused else xs / self.num_kernels
+        x = F.leaky_relu(x)
+        x = self.conv_post(x, final)
+        return torch.tanh(x)
+
+    def push(self, mel):
+        """Feed (B, num_mels, frames) new mel frames; return the (B, 1, samples) audio completed by them."""
+        return self._step(mel, False)
+
+    def flush(self):
+        """Return the audio still held back for the end of the input and reset for the next utterance."""
+        channels = self.generator.conv_pre.in_channels
+        weight = self.generator.conv_pre.weight
+        batch_size = self.conv_pre.buffer.size(0) if self.conv_pre.buffer is not None else 1
+        audio = self._step(weight.new_zeros(batch_size, channels, 0), True)
+        self.reset()
+        return audio
@@ -0,0 +1,103 @@
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+import torch.nn.functional as F
+from sampler import LengthBucketBatchSampler
+
+
+def length_batches(lengths, max_frames, max_batch_size=None):
+    """Index batches of similar-length mels whose padded size stays within `max_frames` frames."""
+    return LengthBucketBatchSampler(lengths, max_frames, max_batch_size).batches
+
+
+def pad_mels(mels):
+    """Stack (num_mels, frames) mels into one (B, num_mels, longest) batch and return it with the lengths.
+
+    Each mel is padded with its own minimum, i.e. silence in both the linear and the log mel domain.
+    """
+    lengths = [m.size(-1) for m in mels]
+    longest = max(lengths)
+    x = torch.stack([F.pad(m, (0, longest - m.size(-1)), 'constant', float(m.min())) for m in mels])
+    return x, lengths
+
+
+def vocode(generator, mels):
+    """Run `generator` on a list of (num_mels, frames) mels as one batch and return each clip's audio.
+
+    Outputs are trimmed back to frames * hop samples, so padding never reaches the written audio.
+    """
+    hop_size = int(np.prod(generator.h.upsample_rates))
+    x, lengths = pad_mels(mels)
+    y_g_hat = generator(x).squeeze(1)
+    return [y_g_hat[i, :length * hop_size] for i, length in enumerate(lengths)]
+
+
+def receptive_field(h):
+    """One-sided receptive field of Generator in mel frames, rounded up.
+
+    Walks the network from conv_post back to conv_pre, adding each layer's reach at its own time
+    resolution and converting to input frames at every transposed convolution.
+    """
+    reach = 3  # conv_post
+    for u, k in reversed(list(zip(h.upsample_rates, h.upsample_kernel_sizes))):
+        branch_reach = []
+        for rk, dilations in zip(h.resblock_kernel_sizes, h.resblock_dilation_sizes):
+            r = sum(d * (rk - 1) // 2 for d in dilations)
+            if h.resblock == '1':
+                r += len(dilations) * (rk - 1) // 2
+            branch_reach.append(r)
+        reach += max(branch_reach)
+        reach = (reach + k + u - 1) // u + 1
+    return reach + 3  # conv_pre
+
+
+def vocode_chunked(generator, mel, chunk_frames, context=None):
+    """Vocode a (num_mels, frames) mel in chunks of `chunk_frames`, with `context` frames on each side.
+
+    The context defaults to the generator's receptive field, so every kept sample sees exactly the input
+    it would see in a full-sequence pass and the chunks are trimmed and concatenated without a
+    crossfade. Results match generator(mel) up to floating-point summation order, while activation
+    memory depends on chunk_frames instead of the input length.
+    """
+    if context is None:
+        context = receptive_field(generator.h)
+    hop_size = int(np.prod(generator.h.upsample_rates))
+    frames = mel.size(-1)
+    audio = []
+    for start in range(0, frames, chunk_frames):
+        end = min(start + chunk_frames, frames)
+        chunk_start = max(0, start - context)
+        chunk_end = min(frames, end + context)
+        y_g_hat = generator(mel[None, :, chunk_start:chunk_end])[0, 0]
+        audio.append(y_g_hat[(start - chunk_start) * hop_size:(end - chunk_start) * hop_size])
+    return torch.cat(audio)
+
+
+def run_pipeline(items, read, compute, write, num_readers=2, num_writers=2, max_pending=4):
+    """Run read -> compute -> write over `items` with disk I/O overlapping the compute stage.
+
+    `read` runs on a pool of `num_readers` threads and `write` on a pool of `num_writers` threads, while
+    `compute` runs in order on the calling thread. At most `max_pending` items wait on either side of
+    the compute stage; beyond that the stage in front blocks, so memory stays bounded.
+    """
+    readers = ThreadPoolExecutor(num_readers)
+    writers = ThreadPoolExecutor(num_writers)
+    items = iter(items)
+    reads = deque(readers.submit(read, item) for item in itertools.islice(items, max_pending))
+    writes = deque()
+    try:
+        while len(reads) > 0:
+            data = reads.popleft().result()
+            for item in itertools.islice(items, 1):
+                reads.append(readers.submit(read, item))
+            result = compute(data)
+            while len(writes) >= max_pending:
+                writes.popleft().result()
+            writes.append(writers.submit(write, result))
+        while len(writes) > 0:
+            writes.popleft().result()
+    finally:
+        readers.shutdown(wait=False)
+        writers.shutdown()
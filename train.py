@@ -1,8 +1,11 @@
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
+import glob
 import itertools
 import os
+import shutil
 import time
+import uuid
 import argparse
 import json
 import torch
@@ -13,26 +16,50 @@ import torch.multiprocessing as mp
 from torch.distributed import init_process_group
 from torch.nn.parallel import DistributedDataParallel
 from env import AttrDict, build_env
-from meldataset import MelDataset, mel_spectrogram, get_dataset_filelist
+from meldataset import MelDataset, mel_spectrogram, mel_frontend
+from manifest import get_manifest, manifest_filelists
+from sampler import LengthBucketBatchSampler, PadCollate, length_mask
+from shards import ShardedMelDataset
+from audio_cache import AudioCache
+from packed_store import PackedAudioStore, PackedMelStore
+from resample_cache import ResampleCache
 from models import Generator, MultiPeriodDiscriminator, MultiScaleDiscriminator, feature_loss, generator_loss,\
     discriminator_loss
-from utils import plot_spectrogram, scan_checkpoint, load_checkpoint, save_checkpoint
-from torchaudio import transforms
+from checkpoint import load_checkpoint
+from utils import plot_spectrogram, scan_checkpoint, CheckpointWriter, set_requires_grad, \
+    process_cores
 
 torch.backends.cudnn.benchmark = True
 
 
 def train(rank, a, h):
-    if h.num_gpus > 1:
+    if h.num_procs > 1:
         init_process_group(backend=h.dist_config['dist_backend'], init_method=h.dist_config['dist_url'],
-                           world_size=h.dist_config['world_size'] * h.num_gpus, rank=rank)
+                           world_size=h.dist_config['world_size'] * h.num_procs, rank=rank)
 
-    torch.cuda.manual_seed(h.seed)
-    device = torch.device('cuda:{:d}'.format(rank))
+    if a.device == 'cuda':
+        torch.cuda.manual_seed(h.seed)
+        device = torch.device('cuda:{:d}'.format(rank))
+    else:
+        device = torch.device('cpu')
+        cores = process_cores(rank, h.num_procs)
+        os.sched_setaffinity(0, cores)
+        torch.set_num_threads(a.intra_op_threads or len(cores))
+        if rank == 0:
+            print('Cores per process :', len(cores), ', intra-op threads :', torch.get_num_threads())
+
+    amp_dtype = {'none': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}[a.amp]
+    if amp_dtype == torch.float16 and device.type != 'cuda':
+        raise ValueError("fp16 autocast needs a GPU, use --amp bf16 on CPU")
+    # Only fp16 has a narrow enough exponent range to need loss scaling.
+    scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
+
+    def autocast():
+        return torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None)
 
     generator = Generator(h).to(device)
-    mpd = MultiPeriodDiscriminator().to(device)
-    msd = MultiScaleDiscriminator().to(device)
+    mpd = MultiPeriodDiscriminator(fused=a.fused_disc, num_threads=a.disc_threads).to(device)
+    msd = MultiScaleDiscriminator(fused=a.fused_disc, num_threads=a.disc_threads).to(device)
 
     if rank == 0:
         print(generator)
@@ -56,10 +83,11 @@ def train(rank, a, h):
         steps = state_dict_do['steps'] + 1
         last_epoch = state_dict_do['epoch']
 
-    if h.num_gpus > 1:
-        generator = DistributedDataParallel(generator, device_ids=[rank]).to(device)
-        mpd = DistributedDataParallel(mpd, device_ids=[rank]).to(device)
-        msd = DistributedDataParallel(msd, device_ids=[rank]).to(device)
+    if h.num_procs > 1:
+        ddp_kwargs = {'device_ids': [rank]} if device.type == 'cuda' else {}
+        generator = DistributedDataParallel(generator, **ddp_kwargs).to(device)
+        mpd = DistributedDataParallel(mpd, **ddp_kwargs).to(device)
+        msd = DistributedDataParallel(msd, **ddp_kwargs).to(device)
 
     optim_g = torch.optim.AdamW(generator.parameters(), h.learning_rate, betas=[h.adam_b1, h.adam_b2])
     optim_d = torch.optim.AdamW(itertools.chain(msd.parameters(), mpd.parameters()),
@@ -68,52 +96,95 @@ def train(rank, a, h):
     if state_dict_do is not None:
         optim_g.load_state_dict(state_dict_do['optim_g'])
         optim_d.load_state_dict(state_dict_do['optim_d'])
+        # A disabled scaler saves {}, which an enabled one refuses to load (e.g. resuming with --amp fp16).
+        if state_dict_do.get('scaler'):
+            scaler.load_state_dict(state_dict_do['scaler'])
 
     scheduler_g = torch.optim.lr_scheduler.ExponentialLR(optim_g, gamma=h.lr_decay, last_epoch=last_epoch)
     scheduler_d = torch.optim.lr_scheduler.ExponentialLR(optim_d, gamma=h.lr_decay, last_epoch=last_epoch)
 
-    training_filelist, validation_filelist = get_dataset_filelist(h)
-
-    mel_spec = transforms.MelSpectrogram(sample_rate=h.sampling_rate,
-                                         n_fft=h.n_fft,
-                                         win_length=h.win_size,
-                                         pad=int((h.n_fft - h.hop_size) / 2),
-                                         pad_mode="reflect",
-                                         hop_length=h.hop_size,
-                                         f_min=h.fmin,
-                                         f_max=h.fmax,
-                                         n_mels=h.num_mels,
-                                         window_fn=torch.hann_window,
-                                         power=2,
-                                         normalized=False,
-                                         center=False,
-                                         onesided=True).to(device)
+    manifest = get_manifest(a.manifest, h)
+    training_filelist, validation_filelist = manifest_filelists(manifest)
+
+    audio_store = None
+    if a.input_packed_audio:
+        audio_store = PackedAudioStore(a.input_packed_audio)
+        if audio_store.sampling_rate != h.sampling_rate:
+            raise ValueError("{} is packed at {} Hz, config expects {} Hz".format(
+                a.input_packed_audio, audio_store.sampling_rate, h.sampling_rate))
+        # Files missing from the store are decoded from wav instead, which would silently cost the speed-up.
+        n_missing = sum(1 for f in training_filelist if f not in audio_store)
+        if n_missing == len(training_filelist):
+            raise ValueError("{} holds none of the {} training files; pack it from the run's manifest".format(
+                a.input_packed_audio, len(training_filelist)))
+        if n_missing > 0 and rank == 0:
+            print('Warning: {} of {} training files are not in {} and are read from wav'.format(
+                n_missing, len(training_filelist), a.input_packed_audio))
+
+    mel_store = PackedMelStore(a.input_packed_mels) if a.fine_tuning and a.input_packed_mels else None
+
+    resample_cache = ResampleCache(a.resample_cache_dir, h.sampling_rate) if a.resample_cache_dir else None
+
+    mel_spec = mel_frontend(h.n_fft, h.num_mels, h.sampling_rate, h.hop_size, h.win_size, h.fmin, h.fmax,
+                            device=device)
+
+    audio_cache = None
+    if a.audio_cache_mb > 0:
+        audio_cache = AudioCache(a.audio_cache_mb * 2**20, dtype=a.audio_cache_dtype, shared=a.shared_audio_cache,
+                                 shared_max_bytes=a.shared_audio_cache_bytes, namespace=a.run_id,
+                                 sampling_rate=h.sampling_rate)
 
     trainset = MelDataset(training_filelist, h.segment_size, h.n_fft, h.num_mels,
-                          h.hop_size, h.win_size, h.sampling_rate, h.fmin, h.fmax, n_cache_reuse=0,
-                          shuffle=False if h.num_gpus > 1 else True, fmax_loss=h.fmax_for_loss, device=device,
-                          fine_tuning=a.fine_tuning, base_mels_path=a.input_mels_dir)
+                          h.hop_size, h.win_size, h.sampling_rate, h.fmin, h.fmax, audio_cache=audio_cache,
+                          shuffle=False if h.num_procs > 1 else True, fmax_loss=h.fmax_for_loss, device=device,
+                          fine_tuning=a.fine_tuning, base_mels_path=a.input_mels_dir, audio_store=audio_store,
+                          resample_cache=resample_cache, compute_mel=not a.device_mel, mel_store=mel_store)
+
+    train_sampler = DistributedSampler(trainset) if h.num_procs > 1 else None
 
-    train_sampler = DistributedSampler(trainset) if h.num_gpus > 1 else None
+    if a.input_shards:
+        trainset = ShardedMelDataset(sorted(glob.glob(a.input_shards)), trainset, seed=h.seed, rank=rank,
+                                     world_size=h.dist_config['world_size'] * h.num_procs)
+        train_sampler = None
 
+    # Per-worker audio caches only survive across epochs when the workers do.
+    persistent_workers = audio_cache is not None and h.num_workers > 0 and not a.input_shards
     train_loader = DataLoader(trainset, num_workers=h.num_workers, shuffle=False,
                               sampler=train_sampler,
                               batch_size=h.batch_size,
-                              pin_memory=True,
-                              drop_last=True)
+                              pin_memory=device.type == 'cuda',
+                              drop_last=True,
+                              persistent_workers=persistent_workers)
 
     if rank == 0:
         validset = MelDataset(validation_filelist, h.segment_size, h.n_fft, h.num_mels,
-                              h.hop_size, h.win_size, h.sampling_rate, h.fmin, h.fmax, False, False, n_cache_reuse=0,
+                              h.hop_size, h.win_size, h.sampling_rate, h.fmin, h.fmax, False, False,
+                              audio_cache=audio_cache,
                               fmax_loss=h.fmax_for_loss, device=device, fine_tuning=a.fine_tuning,
-                              base_mels_path=a.input_mels_dir)
-        validation_loader = DataLoader(validset, num_workers=1, shuffle=False,
-                                       sampler=None,
-                                       batch_size=1,
-                                       pin_memory=True,
-                                       drop_last=True)
+                              base_mels_path=a.input_mels_dir, audio_store=audio_store,
+                              resample_cache=resample_cache, compute_mel=not a.device_mel, mel_store=mel_store)
+        if a.validation_batch_frames > 0:
+            num_frames = {e['path']: e['frames'] * h.sampling_rate // e['sampling_rate'] // h.hop_size
+                          for e in manifest}
+            validation_sampler = LengthBucketBatchSampler([num_frames[f] for f in validset.audio_files],
+                                                          a.validation_batch_frames)
+            validation_loader = DataLoader(validset, num_workers=h.num_workers,
+                                           batch_sampler=validation_sampler,
+                                           collate_fn=PadCollate(h.hop_size),
+                                           pin_memory=device.type == 'cuda',
+                                           persistent_workers=audio_cache is not None and h.num_workers > 0)
+        else:
+            validation_loader = DataLoader(validset, num_workers=1, shuffle=False,
+                                           sampler=None,
+                                           batch_size=1,
+                                           collate_fn=PadCollate(h.hop_size),
+                                           pin_memory=device.type == 'cuda',
+                                           drop_last=True,
+                                           persistent_workers=audio_cache is not None)
 
         sw = SummaryWriter(os.path.join(a.checkpoint_path, 'logs'))
+        checkpoint_writer = CheckpointWriter(a.checkpoint_queue_size, a.keep_checkpoints,
+                                             tensor_file=a.checkpoint_format == 'tensor')
 
     generator.train()
     mpd.train()
@@ -123,38 +194,48 @@ def train(rank, a, h):
             start = time.time()
             print("Epoch: {}".format(epoch+1))
 
-        if h.num_gpus > 1:
+        if train_sampler is not None:
             train_sampler.set_epoch(epoch)
+        elif a.input_shards:
+            trainset.set_epoch(epoch)
 
         for i, batch in enumerate(train_loader):
             if rank == 0:
                 start_b = time.time()
             x, y, _, y_mel = batch
-            x = torch.autograd.Variable(x.to(device, non_blocking=True))
             y = torch.autograd.Variable(y.to(device, non_blocking=True))
-            y_mel = torch.autograd.Variable(y_mel.to(device, non_blocking=True))
+            if a.device_mel:
+                with torch.no_grad():
+                    y_mel = mel_spec(y)
+                x = torch.autograd.Variable(x.to(device, non_blocking=True)) if a.fine_tuning else y_mel
+            else:
+                x = torch.autograd.Variable(x.to(device, non_blocking=True))
+                y_mel = torch.autograd.Variable(y_mel.to(device, non_blocking=True))
             y = y.unsqueeze(1)
 
-            y_g_hat = generator(x)
+            with autocast():
+                y_g_hat = generator(x)
             # print(y_g_hat.shape)
             # y_g_hat_mel = mel_spectrogram(y_g_hat.squeeze(1), h.n_fft, h.num_mels, h.sampling_rate, h.hop_size, h.win_size,
             #                               h.fmin, h.fmax_for_loss)
-            y_g_hat_mel = mel_spec(y_g_hat.squeeze(1))
+            y_g_hat_mel = mel_spec(y_g_hat.squeeze(1).float())
 
             optim_d.zero_grad()
 
             # MPD
-            y_df_hat_r, y_df_hat_g, _, _ = mpd(y, y_g_hat.detach())
+            with autocast():
+                y_df_hat_r, y_df_hat_g, _, _ = mpd(y, y_g_hat.detach())
             loss_disc_f, losses_disc_f_r, losses_disc_f_g = discriminator_loss(y_df_hat_r, y_df_hat_g)
 
             # MSD
-            y_ds_hat_r, y_ds_hat_g, _, _ = msd(y, y_g_hat.detach())
+            with autocast():
+                y_ds_hat_r, y_ds_hat_g, _, _ = msd(y, y_g_hat.detach())
             loss_disc_s, losses_disc_s_r, losses_disc_s_g = discriminator_loss(y_ds_hat_r, y_ds_hat_g)
 
             loss_disc_all = loss_disc_s + loss_disc_f
 
-            loss_disc_all.backward()
-            optim_d.step()
+            scaler.scale(loss_disc_all).backward()
+            scaler.step(optim_d)
 
             # Generator
             optim_g.zero_grad()
@@ -162,16 +243,34 @@ def train(rank, a, h):
             # L1 Mel-Spectrogram Loss
             loss_mel = F.l1_loss(y_mel, y_g_hat_mel) * 45
 
-            y_df_hat_r, y_df_hat_g, fmap_f_r, fmap_f_g = mpd(y, y_g_hat)
-            y_ds_hat_r, y_ds_hat_g, fmap_s_r, fmap_s_g = msd(y, y_g_hat)
+            if a.prune_disc_graph:
+                # The real branch only provides constant feature-matching targets and the discriminator
+                # gradients would be discarded by optim_d.zero_grad(), so build neither. The unwrapped
+                # modules are used so DDP does not wait for gradients that are never produced.
+                mpd_g = mpd.module if h.num_procs > 1 else mpd
+                msd_g = msd.module if h.num_procs > 1 else msd
+                set_requires_grad([mpd_g, msd_g], False)
+                with autocast():
+                    with torch.no_grad():
+                        _, fmap_f_r = mpd_g.discriminate(y)
+                        _, fmap_s_r = msd_g.discriminate(y)
+                    y_df_hat_g, fmap_f_g = mpd_g.discriminate(y_g_hat)
+                    y_ds_hat_g, fmap_s_g = msd_g.discriminate(y_g_hat)
+            else:
+                with autocast():
+                    y_df_hat_r, y_df_hat_g, fmap_f_r, fmap_f_g = mpd(y, y_g_hat)
+                    y_ds_hat_r, y_ds_hat_g, fmap_s_r, fmap_s_g = msd(y, y_g_hat)
             loss_fm_f = feature_loss(fmap_f_r, fmap_f_g)
             loss_fm_s = feature_loss(fmap_s_r, fmap_s_g)
             loss_gen_f, losses_gen_f = generator_loss(y_df_hat_g)
             loss_gen_s, losses_gen_s = generator_loss(y_ds_hat_g)
             loss_gen_all = loss_gen_s + loss_gen_f + loss_fm_s + loss_fm_f + loss_mel
 
-            loss_gen_all.backward()
-            optim_g.step()
+            scaler.scale(loss_gen_all).backward()
+            scaler.step(optim_g)
+            scaler.update()
+            if a.prune_disc_graph:
+                set_requires_grad([mpd_g, msd_g], True)
 
             if rank == 0:
                 # STDOUT logging
@@ -185,16 +284,19 @@ def train(rank, a, h):
                 # checkpointing
                 if steps % a.checkpoint_interval == 0 and steps != 0:
                     checkpoint_path = "{}/g_{:08d}".format(a.checkpoint_path, steps)
-                    save_checkpoint(checkpoint_path,
-                                    {'generator': (generator.module if h.num_gpus > 1 else generator).state_dict()})
+                    checkpoint_writer.save(checkpoint_path,
+                                           {'generator': (generator.module if h.num_procs > 1
+                                                          else generator).state_dict()},
+                                           prefix='g_')
                     checkpoint_path = "{}/do_{:08d}".format(a.checkpoint_path, steps)
-                    save_checkpoint(checkpoint_path, 
-                                    {'mpd': (mpd.module if h.num_gpus > 1
-                                                         else mpd).state_dict(),
-                                     'msd': (msd.module if h.num_gpus > 1
-                                                         else msd).state_dict(),
-                                     'optim_g': optim_g.state_dict(), 'optim_d': optim_d.state_dict(), 'steps': steps,
-                                     'epoch': epoch})
+                    checkpoint_writer.save(checkpoint_path,
+                                           {'mpd': (mpd.module if h.num_procs > 1
+                                                                else mpd).state_dict(),
+                                            'msd': (msd.module if h.num_procs > 1
+                                                                else msd).state_dict(),
+                                            'optim_g': optim_g.state_dict(), 'optim_d': optim_d.state_dict(),
+                                            'steps': steps, 'epoch': epoch, 'scaler': scaler.state_dict()},
+                                           prefix='do_')
 
                 # Tensorboard summary logging
                 if steps % a.summary_interval == 0:
@@ -204,33 +306,48 @@ def train(rank, a, h):
                 # Validation
                 if steps % a.validation_interval == 0:  # and steps != 0:
                     generator.eval()
-                    torch.cuda.empty_cache()
+                    if device.type == 'cuda':
+                        torch.cuda.empty_cache()
                     val_err_tot = 0
+                    val_clips = 0
                     with torch.no_grad():
                         for j, batch in enumerate(validation_loader):
-                            x, y, _, y_mel = batch
+                            x, y, _, y_mel, lengths = batch
+                            if a.device_mel:
+                                y_mel = mel_spec(y.to(device, non_blocking=True))
+                                x = x.to(device) if a.fine_tuning else y_mel
                             y_g_hat = generator(x.to(device))
                             y_mel = torch.autograd.Variable(y_mel.to(device, non_blocking=True))
                             # y_g_hat_mel = mel_spectrogram(y_g_hat.squeeze(1), h.n_fft, h.num_mels, h.sampling_rate,
                             #                               h.hop_size, h.win_size,
                             #                               h.fmin, h.fmax_for_loss)
                             y_g_hat_mel = mel_spec(y_g_hat.squeeze(1))
-                            val_err_tot += F.l1_loss(y_mel, y_g_hat_mel).item()
+                            # Per-clip mel L1 over the valid (unpadded) frames only.
+                            lengths = lengths.to(device)
+                            mask = length_mask(lengths, y_mel.size(-1))
+                            clip_err = (torch.abs(y_mel - y_g_hat_mel) * mask).sum(dim=(1, 2)) / \
+                                (lengths * y_mel.size(1))
+                            val_err_tot += clip_err.sum().item()
+                            val_clips += clip_err.size(0)
 
                             if j <= 4:
+                                n_frames = int(lengths[0])
                                 if steps == 0:
-                                    sw.add_audio('gt/y_{}'.format(j), y[0], steps, h.sampling_rate)
-                                    sw.add_figure('gt/y_spec_{}'.format(j), plot_spectrogram(x[0]), steps)
+                                    sw.add_audio('gt/y_{}'.format(j), y[0, :n_frames * h.hop_size], steps,
+                                                 h.sampling_rate)
+                                    sw.add_figure('gt/y_spec_{}'.format(j), plot_spectrogram(x[0, :, :n_frames].cpu()),
+                                                  steps)
 
-                                sw.add_audio('generated/y_hat_{}'.format(j), y_g_hat[0], steps, h.sampling_rate)
+                                sw.add_audio('generated/y_hat_{}'.format(j), y_g_hat[0, :, :n_frames * h.hop_size],
+                                             steps, h.sampling_rate)
                                 # y_hat_spec = mel_spectrogram(y_g_hat.squeeze(1), h.n_fft, h.num_mels,
                                 #                              h.sampling_rate, h.hop_size, h.win_size,
                                 #                              h.fmin, h.fmax)
-                                y_hat_spec = mel_spec(y_g_hat.squeeze(1))
+                                y_hat_spec = mel_spec(y_g_hat[:1].squeeze(1))
                                 sw.add_figure('generated/y_hat_spec_{}'.format(j),
-                                              plot_spectrogram(y_hat_spec.squeeze(0).cpu().numpy()), steps)
+                                              plot_spectrogram(y_hat_spec[0, :, :n_frames].cpu().numpy()), steps)
 
-                        val_err = val_err_tot / (j+1)
+                        val_err = val_err_tot / val_clips
                         sw.add_scalar("validation/mel_spec_error", val_err, steps)
 
                     generator.train()
@@ -243,6 +360,9 @@ def train(rank, a, h):
         if rank == 0:
             print('Time taken for epoch {} is {} sec\n'.format(epoch + 1, int(time.time() - start)))
 
+    if rank == 0:
+        checkpoint_writer.close()
+
 
 def main():
     print('Initializing Training Process..')
@@ -252,16 +372,37 @@ def main():
     parser.add_argument('--group_name', default=None)
     parser.add_argument('--input_wavs_dir', default='LJSpeech-1.1/wavs')
     parser.add_argument('--input_mels_dir', default='ft_dataset')
+    parser.add_argument('--input_packed_audio', default=None)
+    parser.add_argument('--input_packed_mels', default=None)
+    parser.add_argument('--resample_cache_dir', default=None)
+    parser.add_argument('--input_shards', default=None)
+    parser.add_argument('--audio_cache_mb', default=0, type=int)
+    parser.add_argument('--audio_cache_dtype', default='float32', choices=['float32', 'int16'])
+    parser.add_argument('--shared_audio_cache', action='store_true')
+    parser.add_argument('--shared_audio_cache_mb', default=0, type=int)
     parser.add_argument('--input_training_file', default='LJSpeech-1.1/training.txt')
     parser.add_argument('--input_validation_file', default='LJSpeech-1.1/validation.txt')
     parser.add_argument('--checkpoint_path', default='cp_hifigan3')
+    parser.add_argument('--manifest', default=None)
     parser.add_argument('--config', default='')
     parser.add_argument('--training_epochs', default=3100, type=int)
     parser.add_argument('--stdout_interval', default=5, type=int)
     parser.add_argument('--checkpoint_interval', default=5000, type=int)
+    parser.add_argument('--checkpoint_queue_size', default=1, type=int)
+    parser.add_argument('--keep_checkpoints', default=0, type=int)
+    parser.add_argument('--checkpoint_format', default='torch', choices=['torch', 'tensor'])
     parser.add_argument('--summary_interval', default=100, type=int)
     parser.add_argument('--validation_interval', default=1000, type=int)
+    parser.add_argument('--validation_batch_frames', default=0, type=int)
     parser.add_argument('--fine_tuning', default=False, type=bool)
+    parser.add_argument('--device_mel', action='store_true')
+    parser.add_argument('--prune_disc_graph', action='store_true')
+    parser.add_argument('--fused_disc', action='store_true')
+    parser.add_argument('--disc_threads', default=1, type=int)
+    parser.add_argument('--amp', default='none', choices=['none', 'bf16', 'fp16'])
+    parser.add_argument('--device', default=None, choices=['cuda', 'cpu'])
+    parser.add_argument('--num_procs', default=1, type=int)
+    parser.add_argument('--intra_op_threads', default=0, type=int)
 
     a = parser.parse_args()
 
@@ -272,17 +413,46 @@ def main():
     h = AttrDict(json_config)
     build_env(a.config, 'config.json', a.checkpoint_path)
 
+    # Scan and resample once before spawning, so every rank shares the same persisted split and cache.
+    if a.manifest is None:
+        a.manifest = os.path.join(a.checkpoint_path, 'manifest.jsonl')
+    manifest = get_manifest(a.manifest, h)
+    if a.resample_cache_dir:
+        training_filelist, validation_filelist = manifest_filelists(manifest)
+        n_resampled = ResampleCache(a.resample_cache_dir, h.sampling_rate).build(
+            training_filelist + validation_filelist, h.num_workers)
+        print("Resampled {} files into {}".format(n_resampled, a.resample_cache_dir))
+
     torch.manual_seed(h.seed)
-    if torch.cuda.is_available():
+    if a.device is None:
+        a.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if a.device == 'cuda':
+        if not torch.cuda.is_available():
+            raise ValueError("--device cuda was requested but no GPU is available")
         torch.cuda.manual_seed(h.seed)
         h.num_gpus = torch.cuda.device_count()
+        h.num_procs = h.num_gpus
         h.batch_size = int(h.batch_size / h.num_gpus)
         print('Batch size per GPU :', h.batch_size)
     else:
-        pass
-
-    if h.num_gpus > 1:
-        mp.spawn(train, nprocs=h.num_gpus, args=(a, h,))
+        h.num_procs = a.num_procs
+        h.batch_size = int(h.batch_size / h.num_procs)
+        if h.dist_config['dist_backend'] == 'nccl':
+            h.dist_config['dist_backend'] = 'gloo'
+        print('Batch size per CPU process :', h.batch_size)
+
+    # The shared audio cache budget covers every process on the host. It is capped at the free space of
+    # /dev/shm, since writing past that raises SIGBUS in the workers instead of an error.
+    a.run_id = 'hifigan_{}'.format(uuid.uuid4().hex[:12])
+    a.shared_audio_cache_bytes = 0
+    if a.shared_audio_cache:
+        budget = (a.shared_audio_cache_mb or a.audio_cache_mb) * 2**20
+        if os.path.isdir('/dev/shm'):
+            budget = min(budget, shutil.disk_usage('/dev/shm').free)
+        a.shared_audio_cache_bytes = budget // ((h.num_procs + 1) * max(h.num_workers, 1))
+
+    if h.num_procs > 1:
+        mp.spawn(train, nprocs=h.num_procs, args=(a, h,))
     else:
         train(0, a, h)
 
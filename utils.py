@@ -1,8 +1,11 @@
 import glob
 import os
+import queue
+import threading
 import matplotlib
 import torch
 from torch.nn.utils import weight_norm
+from checkpoint import save_tensor_file
 matplotlib.use("Agg")
 import matplotlib.pylab as plt
 
@@ -31,22 +34,116 @@ def apply_weight_norm(m):
         weight_norm(m)
 
 
+def set_requires_grad(modules, requires_grad):
+    for m in modules:
+        for p in m.parameters():
+            p.requires_grad_(requires_grad)
+
+
+def process_cores(rank, num_procs):
+    """Disjoint, equally sized slice of this machine's usable cores for local process `rank` of `num_procs`."""
+    cores = sorted(os.sched_getaffinity(0))
+    per_proc = max(len(cores) // num_procs, 1)
+    start = (rank * per_proc) % len(cores)
+    return cores[start:start + per_proc]
+
+
 def get_padding(kernel_size, dilation=1):
     return int((kernel_size*dilation - dilation)/2)
 
 
-def load_checkpoint(filepath, device):
-    assert os.path.isfile(filepath)
-    print("Loading '{}'".format(filepath))
-    checkpoint_dict = torch.load(filepath, map_location=device)
+def save_checkpoint(filepath, obj, tensor_file=False):
+    print("Saving checkpoint to {}".format(filepath))
+    # Write beside the target and rename, so an interrupted save never leaves a truncated checkpoint
+    # that scan_checkpoint would pick up.
+    tmp_path = filepath + '.tmp'
+    if tensor_file:
+        save_tensor_file(tmp_path, obj)
+    else:
+        torch.save(obj, tmp_path)
+    os.replace(tmp_path, filepath)
     print("Complete.")
-    return checkpoint_dict
 
 
-def save_checkpoint(filepath, obj):
-    print("Saving checkpoint to {}".format(filepath))
-    torch.save(obj, filepath)
-    print("Complete.")
+def snapshot_state(obj):
+    """Copy every tensor in a (nested) state dict to CPU, into pinned memory for CUDA tensors.
+
+    The copy is taken before returning, so training may keep updating the source tensors in place.
+    """
+    copied_cuda = []
+
+    def copy(o):
+        if torch.is_tensor(o):
+            o = o.detach()
+            if o.is_cuda:
+                t = torch.empty(o.size(), dtype=o.dtype, pin_memory=True)
+                t.copy_(o, non_blocking=True)
+                copied_cuda.append(o.device)
+                return t
+            return o.clone()
+        if isinstance(o, dict):
+            return type(o)((k, copy(v)) for k, v in o.items())
+        if isinstance(o, (list, tuple)):
+            return type(o)(copy(v) for v in o)
+        return o
+
+    snapshot = copy(obj)
+    for device in set(copied_cuda):
+        torch.cuda.synchronize(device)
+    return snapshot
+
+
+class CheckpointWriter(object):
+    """Save checkpoints on a background thread so the training loop only pays for a device-to-host copy.
+
+    `save` snapshots the state with snapshot_state and queues it; at most `max_pending` snapshots wait
+    in the queue, after which `save` blocks until the writer catches up. Files are written atomically
+    through save_checkpoint, as tensor files when `tensor_file` is set. With `keep_last` > 0 only the newest
+    `keep_last` checkpoints of each prefix are kept. An error in the writer thread is raised by the next
+    `save` or `close`.
+    """
+    def __init__(self, max_pending=1, keep_last=0, tensor_file=False):
+        self.keep_last = keep_last
+        self.tensor_file = tensor_file
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                filepath, obj, prefix = item
+                save_checkpoint(filepath, obj, self.tensor_file)
+                if prefix is not None and self.keep_last > 0:
+                    remove_old_checkpoints(os.path.dirname(filepath), prefix, self.keep_last)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def save(self, filepath, obj, prefix=None):
+        """Queue `obj` to be written to `filepath`; `prefix` names its series for the retention policy."""
+        self._raise_error()
+        self._queue.put((filepath, snapshot_state(obj), prefix))
+
+    def wait(self):
+        """Block until every queued checkpoint is on disk."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
 
 
 def scan_checkpoint(cp_dir, prefix):
@@ -56,3 +153,9 @@ def scan_checkpoint(cp_dir, prefix):
         return None
     return sorted(cp_list)[-1]
 
+
+def remove_old_checkpoints(cp_dir, prefix, keep_last):
+    cp_list = sorted(glob.glob(os.path.join(cp_dir, prefix + '????????')))
+    for filepath in cp_list[:-keep_last]:
+        os.remove(filepath)
+